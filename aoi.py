@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+import os, sys, csv, argparse, tokenize, numpy as np, pandas
+from collections import namedtuple
+from cStringIO import StringIO
+
+# Stimulus programs are programs/<base>_<version>.py
+PROGRAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+
+# Screen position of the first character and size of a character cell
+# (programs were shown in a monospace font)
+Layout = namedtuple("Layout", ["left", "top", "char_width", "line_height"])
+DEFAULT_LAYOUT = Layout(left=0, top=0, char_width=10, line_height=20)
+
+# Tokens that don't cover any characters
+SKIP_TOKENS = set([tokenize.NEWLINE, tokenize.NL, tokenize.INDENT,
+    tokenize.DEDENT, tokenize.ENDMARKER])
+
+# An area of interest: a span of characters on one line of code and its
+# screen rectangle [x0, x1) x [y0, y1)
+AOI_DTYPE = np.dtype([
+    ("line", "<i4"),
+    ("start", "<i4"),
+    ("end", "<i4"),
+    ("x0", "<f4"),
+    ("y0", "<f4"),
+    ("x1", "<f4"),
+    ("y1", "<f4")
+])
+
+def program_path(base, version, programs_dir=PROGRAMS_DIR):
+    """Returns the path of a program's source (programs/<base>_<version>.py)"""
+    return os.path.join(programs_dir, "{0}_{1}.py".format(base, version))
+
+def read_program(base, version, programs_dir=PROGRAMS_DIR):
+    """Returns the source code of a program"""
+    with open(program_path(base, version, programs_dir), "r") as code_file:
+        return code_file.read()
+
+def make_aois(spans, layout):
+    """Lays out (line, start column, end column) character spans as AOIs"""
+    aois = np.zeros(len(spans), dtype=AOI_DTYPE)
+    if len(spans) == 0:
+        return aois
+
+    spans = np.asarray(spans)
+    aois["line"], aois["start"], aois["end"] = spans[:, 0], spans[:, 1], spans[:, 2]
+    aois["x0"] = layout.left + (aois["start"] * layout.char_width)
+    aois["x1"] = layout.left + (aois["end"] * layout.char_width)
+    aois["y0"] = layout.top + (aois["line"] * layout.line_height)
+    aois["y1"] = aois["y0"] + layout.line_height
+
+    return aois
+
+def line_aois(code, layout=DEFAULT_LAYOUT):
+    """Returns an AOI for each line of code (0-based), all as wide as the
+    longest line so gaze past the end of a short line still counts"""
+    lines = code.rstrip("\n").split("\n") if len(code.strip()) > 0 else []
+    width = max(len(line.rstrip()) for line in lines) if lines else 0
+    return make_aois([(i, 0, width) for i in range(len(lines))], layout)
+
+def token_aois(code, layout=DEFAULT_LAYOUT):
+    """Returns an AOI for each token of code and a list of the token
+    strings. Tokens spanning several lines get one AOI per line."""
+    spans = []
+    texts = []
+    lines = code.split("\n")
+    for kind, text, (row, col), (end_row, end_col), _ in \
+            tokenize.generate_tokens(StringIO(code).readline):
+        if kind in SKIP_TOKENS:
+            continue
+
+        for r in range(row, end_row + 1):
+            start = col if r == row else 0
+            end = end_col if r == end_row else len(lines[r - 1])
+            if end > start:
+                spans.append((r - 1, start, end))
+                texts.append(lines[r - 1][start:end])
+
+    return make_aois(spans, layout), texts
+
+class GridIndex(object):
+    """Spatial index over rectangles using uniform grid buckets. Each cell
+    holds the rectangles overlapping it, so points are
+    hit-tested against a handful of candidates with array operations
+    instead of every rectangle."""
+
+    def __init__(self, aois, cell_width, cell_height):
+        self.aois = aois
+        self.cell_width = float(cell_width)
+        self.cell_height = float(cell_height)
+
+        self.left, self.top = 0.0, 0.0
+        self.cells = -np.ones((1, 1, 1), dtype=int)
+        if len(aois) == 0:
+            return
+
+        left, top = float(aois["x0"].min()), float(aois["y0"].min())
+        cols = int(np.ceil((aois["x1"].max() - left) / self.cell_width))
+        rows = int(np.ceil((aois["y1"].max() - top) / self.cell_height))
+        if (cols <= 0) or (rows <= 0):
+            return  # Only empty rectangles
+
+        self.left, self.top = left, top
+
+        # Cell ranges covered by each rectangle
+        c0 = np.floor((aois["x0"] - self.left) / self.cell_width).astype(int)
+        c1 = np.ceil((aois["x1"] - self.left) / self.cell_width).astype(int)
+        r0 = np.floor((aois["y0"] - self.top) / self.cell_height).astype(int)
+        r1 = np.ceil((aois["y1"] - self.top) / self.cell_height).astype(int)
+
+        buckets = [[[] for _ in range(cols)] for _ in range(rows)]
+        for i in range(len(aois)):
+            for r in range(r0[i], r1[i]):
+                for c in range(c0[i], c1[i]):
+                    buckets[r][c].append(i)
+
+        depth = max(1, max(len(b) for row in buckets for b in row))
+        self.cells = -np.ones((rows, cols, depth), dtype=int)
+        for r in range(rows):
+            for c in range(cols):
+                self.cells[r, c, :len(buckets[r][c])] = buckets[r][c]
+
+    def query(self, x, y):
+        """Returns the index of the first AOI containing each point (x, y),
+        or -1 for points outside every AOI"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        hits = -np.ones(x.shape, dtype=int)
+        if (len(self.aois) == 0) or (x.size == 0):
+            return hits
+
+        rows, cols, depth = self.cells.shape
+        with np.errstate(invalid="ignore"):
+            c = np.floor((x - self.left) / self.cell_width)
+            r = np.floor((y - self.top) / self.cell_height)
+            inside = (c >= 0) & (c < cols) & (r >= 0) & (r < rows)
+
+        points = np.flatnonzero(inside)
+        candidates = self.cells[r[points].astype(int), c[points].astype(int)]
+        px, py = x[points], y[points]
+
+        # Test candidates in order; the first containing AOI wins
+        found = -np.ones(len(points), dtype=int)
+        for k in range(depth):
+            aoi = candidates[:, k]
+            todo = np.flatnonzero((found < 0) & (aoi >= 0))
+            if len(todo) == 0:
+                break
+
+            rects = self.aois[aoi[todo]]
+            contains = (rects["x0"] <= px[todo]) & (px[todo] < rects["x1"]) & \
+                    (rects["y0"] <= py[todo]) & (py[todo] < rects["y1"])
+            found[todo[contains]] = aoi[todo[contains]]
+
+        hits[points] = found
+        return hits
+
+class ProgramAOIs(object):
+    """Line and token AOIs of a stimulus program with spatial indexes"""
+
+    def __init__(self, code, layout=DEFAULT_LAYOUT):
+        self.layout = layout
+        self.lines = line_aois(code, layout)
+        self.tokens, self.token_texts = token_aois(code, layout)
+        self.line_index = GridIndex(self.lines, layout.char_width, layout.line_height)
+        self.token_index = GridIndex(self.tokens, layout.char_width, layout.line_height)
+
+    @classmethod
+    def load(cls, base, version, layout=DEFAULT_LAYOUT, programs_dir=PROGRAMS_DIR):
+        """Builds the AOIs of a program in the programs directory"""
+        return cls(read_program(base, version, programs_dir), layout)
+
+    def assign(self, x, y):
+        """Returns the line (0-based) and token index under each point, with
+        -1 for points off the code"""
+        line_hits = self.line_index.query(x, y)
+        lines = -np.ones_like(line_hits)
+        hit = line_hits >= 0
+        lines[hit] = self.lines["line"][line_hits[hit]]
+        return lines, self.token_index.query(x, y)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assigns fixations to line and token areas of interest in a program")
+    parser.add_argument("--base", type=str, required=True, help="Program base")
+    parser.add_argument("--version", type=str, required=True, help="Program version")
+    parser.add_argument("--left", type=float, default=DEFAULT_LAYOUT.left,
+            help="Screen x of the first character (pixels)")
+    parser.add_argument("--top", type=float, default=DEFAULT_LAYOUT.top,
+            help="Screen y of the first line (pixels)")
+    parser.add_argument("--char-width", type=float, default=DEFAULT_LAYOUT.char_width,
+            help="Width of a character (pixels)")
+    parser.add_argument("--line-height", type=float, default=DEFAULT_LAYOUT.line_height,
+            help="Height of a line (pixels)")
+    parser.add_argument("fixations", type=str, nargs="?", default=None,
+            help="Fixations csv file with x and y columns (see fixations.py). If omitted, the AOIs are printed.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write csv to a file instead of stdout")
+    args = parser.parse_args()
+
+    layout = Layout(args.left, args.top, args.char_width, args.line_height)
+    aois = ProgramAOIs.load(args.base, args.version, layout)
+
+    out_file = sys.stdout
+    if args.output is not None:
+        out_file = open(args.output, "wb")
+
+    if args.fixations is None:
+        # Print token AOIs
+        writer = csv.writer(out_file)
+        writer.writerow(("token",) + AOI_DTYPE.names + ("text",))
+        for i, (aoi, text) in enumerate(zip(aois.tokens.tolist(), aois.token_texts)):
+            writer.writerow((i,) + aoi + (text,))
+    else:
+        fixations = pandas.read_csv(args.fixations)
+        fixations["line"], fixations["token"] = aois.assign(fixations["x"].values,
+                fixations["y"].values)
+        fixations.to_csv(out_file, index=False)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+import io, os, re, sys, json, argparse, multiprocessing, pandas
+from lxml import etree
+from collections import defaultdict
+from response_stats import RESPONSE_THRESHOLD, open_xml, parse_experiments, \
+        iter_experiments, experiment_rows, frame_from_rows, program_summary, \
+        program_plot_tasks, render_plots, grade_vs_experience, demographics
+from response_store import STORE_EXT
+from trial_cache import cache_paths, append_log_path, cached_trials, load_trials, \
+        source_stamp, append_trials, save_trials
+from grade_trial import grade_trials, expected_output
+
+# Bump when the layout of the aggregates file changes
+AGGREGATES_VERSION = 2
+
+ROOT_START = re.compile(br"<experiments[\s>/]")
+
+# Leading XML declaration of a file
+DECLARATION = re.compile(br"^\s*<\?xml[^>]*\?>")
+
+# Start and end of an append log
+LOG_START = b"<?xml version='1.0' encoding='UTF-8'?>\n<experiments>\n"
+LOG_END = b"</experiments>"
+
+# Reading new experiments {{{
+
+def grade_new_trials(e, regrade=False):
+    """Auto-grades the trials of an XML experiment that don't have a grade
+    yet (or all of them if regrade is True), setting their grade
+    attributes. Trials that need a manual grade keep an existing grade, or
+    are marked "manual" with a value of -1. Returns the number graded."""
+    trials = [t for t in e.iterfind("trials/trial")
+            if regrade or not t.get("grade-category")]
+
+    responses = []
+    for t in trials:
+        base, version = t.get("base"), t.get("version")
+        true_output = t.findtext("true-output")
+        if true_output is None:
+            true_output = expected_output(base, version) or ""
+
+        responses.append((t.get("id"), base, version, true_output,
+            t.findtext("predicted-output", "")))
+
+    for t, (_, _, _, category, value) in zip(trials, grade_trials(responses)):
+        if (category == "manual") and t.get("grade-category"):
+            continue  # Keep the existing (manual) grade
+
+        t.set("grade-category", category)
+        t.set("grade-value", str(value))
+        t.set("auto-graded", str(category != "manual"))
+
+    return len(trials)
+
+def read_new_trials(path, regrade=False):
+    """Reads new experiments from a response data XML file, a file with
+    just <experiment> elements, or a store file, grading trials as needed.
+    Returns a trial data frame, the number of trials that were graded and
+    the (exp_id, XML) of each graded experiment."""
+    if path.endswith(STORE_EXT):
+        experiments = iter_experiments(path)
+    else:
+        with open_xml(path) as xml_file:
+            data = xml_file.read()
+
+        if ROOT_START.search(data) is None:
+            # The root goes after the declaration, which must come first
+            match = DECLARATION.match(data)
+            prolog_end = 0 if match is None else match.end()
+            data = data[:prolog_end] + b"<experiments>" + data[prolog_end:] + \
+                    b"</experiments>"
+
+        experiments = parse_experiments(io.BytesIO(data))
+
+    rows = []
+    graded = 0
+    xml = []
+    for e in experiments:
+        graded += grade_new_trials(e, regrade)
+        rows.extend(experiment_rows(e))
+        xml.append((int(e.attrib["id"]), etree.tostring(e, with_tail=False) + b"\n"))
+
+    return frame_from_rows(rows), graded, xml
+
+# }}}
+
+# Append log {{{
+
+def add_to_log(log_path, experiments):
+    """Adds serialized <experiment> elements to the end of an append log
+    (see trial_cache.append_log_path), creating it if needed"""
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as log_file:
+            data = log_file.read()
+
+        data = data[:data.rindex(LOG_END)]
+    else:
+        data = LOG_START
+
+    with open(log_path + ".tmp", "wb") as log_file:
+        log_file.write(data + b"".join(experiments) + LOG_END + b"\n")
+
+    os.rename(log_path + ".tmp", log_path)
+
+# }}}
+
+# Running aggregates {{{
+
+def aggregates_path(xml_path):
+    """Returns the path of the running aggregates of xml_path's trials"""
+    return "{0}.aggregates.json".format(xml_path)
+
+def moments(values):
+    """Returns [count, mean, sum of squared deviations] of values"""
+    n = len(values)
+    if n == 0:
+        return [0, 0.0, 0.0]
+
+    mean = float(values.mean())
+    return [n, mean, float(((values - mean) ** 2).sum())]
+
+def merge_moments(a, b):
+    """Combines two [count, mean, M2] moments (Chan et al.)"""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return [0, 0.0, 0.0]
+
+    delta = mean_b - mean_a
+    mean = mean_a + (delta * n_b / float(n))
+    m2 = m2_a + m2_b + ((delta ** 2) * n_a * n_b / float(n))
+
+    return [n, mean, m2]
+
+def trial_aggregates(df, threshold=RESPONSE_THRESHOLD):
+    """Computes trial count, grade category counts and per-version response
+    time moments (up to threshold seconds, like program_summary) of a
+    trial data frame"""
+    response_times = defaultdict(dict)
+    for (b, v), v_df in df.groupby(["base", "version"], observed=True):
+        durations = v_df["duration"].values
+        response_times[str(b)][str(v)] = moments(durations[durations <= threshold])
+
+    grade_categories = df["grade_category"].astype(str).value_counts()
+
+    return {
+        "trials": len(df),
+        "grade_categories": dict((c, int(n)) for c, n in grade_categories.iteritems()),
+        "response_times": dict(response_times)
+    }
+
+def merge_aggregates(aggregates, new):
+    """Adds the aggregates of new trials to running aggregates (in place)"""
+    aggregates["trials"] += new["trials"]
+
+    categories = aggregates["grade_categories"]
+    for c, n in new["grade_categories"].iteritems():
+        categories[c] = categories.get(c, 0) + n
+
+    for b, versions in new["response_times"].iteritems():
+        b_moments = aggregates["response_times"].setdefault(b, {})
+        for v, m in versions.iteritems():
+            b_moments[v] = merge_moments(b_moments.get(v, [0, 0.0, 0.0]), m)
+
+    return aggregates
+
+def read_aggregates(xml_path, sources):
+    """Reads the running aggregates for the cached trials of xml_path, or
+    returns None if they are missing or don't match the cache's sources"""
+    try:
+        with open(aggregates_path(xml_path), "r") as agg_file:
+            aggregates = json.load(agg_file)
+    except (IOError, ValueError):
+        return None
+
+    if (aggregates.get("version") != AGGREGATES_VERSION) or \
+            (aggregates.get("sources") != [s["sha1"] for s in sources]):
+        return None
+
+    return aggregates
+
+def write_aggregates(xml_path, aggregates, sources):
+    """Writes the running aggregates for the cache sources (atomically)"""
+    aggregates = dict(aggregates, version=AGGREGATES_VERSION,
+            sources=[s["sha1"] for s in sources])
+
+    path = aggregates_path(xml_path)
+    with open(path + ".tmp", "w") as agg_file:
+        json.dump(aggregates, agg_file, indent=2, sort_keys=True)
+
+    os.rename(path + ".tmp", path)
+
+# }}}
+
+def append_experiments(xml_path, new_paths, regrade=False):
+    """Appends the experiments in new_paths to the cached trial table of
+    xml_path, updating its running aggregates. The graded experiments are
+    added to the append log of xml_path first, so they are replayed if
+    the cache is rebuilt. Experiments whose id is already in the table are
+    skipped. Returns the full trial table, the aggregates, the new trials
+    and the number of trials that were graded."""
+    df, sources = cached_trials(xml_path)
+    if df is None:
+        load_trials(xml_path, refresh=True)
+        df, sources = cached_trials(xml_path)
+        if df is None:
+            raise ValueError("Trial cache is unavailable (is pyarrow installed?)")
+
+    aggregates = read_aggregates(xml_path, sources)
+    if aggregates is None:
+        aggregates = trial_aggregates(df)
+
+    new_dfs = []
+    logged = []
+    graded = 0
+    for path in new_paths:
+        new_df, n_graded, experiments = read_new_trials(path, regrade)
+        known = new_df["exp_id"].isin(df["exp_id"])
+        if known.any():
+            print >>sys.stderr, "Skipping {0} experiment(s) already in the table: {1}".format(
+                    new_df.loc[known, "exp_id"].nunique(),
+                    ", ".join(str(i) for i in sorted(new_df.loc[known, "exp_id"].unique())))
+            new_df = new_df[~known]
+
+        if len(new_df) == 0:
+            continue
+
+        df = append_trials(df, new_df)
+        merge_aggregates(aggregates, trial_aggregates(new_df))
+        new_ids = set(new_df["exp_id"])
+        logged.extend(x for exp_id, x in experiments if exp_id in new_ids)
+        new_dfs.append(new_df)
+        graded += n_graded
+
+    if len(new_dfs) > 0:
+        log_path = append_log_path(xml_path)
+        add_to_log(log_path, logged)
+        sources = [s for s in sources if s["path"] != os.path.abspath(log_path)] + \
+                [source_stamp(log_path)]
+
+        if not save_trials(df, xml_path, sources):
+            raise ValueError("Trial cache is unavailable (is pyarrow installed?)")
+
+        write_aggregates(xml_path, aggregates, sources)
+
+    new_df = pandas.concat(new_dfs, ignore_index=True) if len(new_dfs) > 0 \
+            else frame_from_rows([])
+
+    return df, aggregates, new_df, graded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Appends new experiments to the cached trial table and updates plots for the affected programs")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("new_files", type=str, nargs="+",
+            help="XML files with new <experiment> elements (with or without an <experiments> root), or store files")
+    parser.add_argument("--regrade", action="store_true",
+            help="Auto-grade all new trials, not just the ones without a grade")
+    parser.add_argument("--no-plots", action="store_true",
+            help="Only update the trial table and aggregates")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of worker processes for plotting (default: number of cores)")
+    args = parser.parse_args()
+
+    trial_df, aggregates, new_df, graded = append_experiments(args.xml_file,
+            args.new_files, args.regrade)
+
+    print "Appended {0} experiments ({1} trials, {2} graded)".format(
+            new_df["exp_id"].nunique(), len(new_df), graded)
+
+    print "{0} trials cached in {1}".format(aggregates["trials"],
+            cache_paths(args.xml_file)[0])
+
+    print "\nGrade categories"
+    for c, n in sorted(aggregates["grade_categories"].iteritems(), key=lambda cn: -cn[1]):
+        print "{0:<20} {1}".format(c, n)
+
+    updated = sorted(set(str(b) for b in new_df["base"]))
+    if len(updated) > 0:
+        print "\nResponse times (up to {0} s)".format(RESPONSE_THRESHOLD)
+        for b in updated:
+            for v, (n, mean, m2) in sorted(aggregates["response_times"][b].iteritems()):
+                std = (m2 / (n - 1)) ** 0.5 if n > 1 else float("nan")
+                print "{0} {1} - n: {2}, mean: {3}, std: {4}".format(b, v, n, mean, std)
+
+    if args.no_plots or (len(new_df) == 0):
+        sys.exit(0)
+
+    if not os.path.exists("plots"):
+        os.makedirs("plots")
+
+    # Overall plots include every participant
+    grade_vs_experience(trial_df)
+    demographics(trial_df.drop_duplicates("exp_id"))
+
+    # Program plots only for bases with new trials
+    summary = program_summary(trial_df)
+    tasks = [t for t in program_plot_tasks(trial_df, summary) if t[3][0] in updated]
+    rendered = render_plots(tasks, args.processes or multiprocessing.cpu_count())
+    print "Rendered {0} program plots for {1}".format(len(rendered), ", ".join(updated))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import argparse, timeit, numpy as np
+from pretty_plot import smooth1d, smooth2d, SHADOW_WINDOW
+
+def legacy_smooth2d(A, sigma=3):
+    """Row-by-row smoothing used by pretty_plot before vectorization"""
+    window_len = max(int(sigma), 3)*2+1
+    A1 = np.array([smooth1d(x, window_len) for x in np.asarray(A)])
+    A2 = np.transpose(A1)
+    A3 = np.array([smooth1d(x, window_len) for x in A2])
+    A4 = np.transpose(A3)
+
+    return A4
+
+def pie_alpha(dpi, size, sigma):
+    """Alpha channel of a pie chart (a disc) as rendered for the drop
+    shadow filter, padded like GaussianFilter"""
+    pad = int(sigma*3/72.*dpi)
+    n = int(size * dpi)
+    yy, xx = np.mgrid[0:n, 0:n]
+    r = n / 2.0
+    disc = (((xx - r) ** 2 + (yy - r) ** 2) <= (0.8 * r) ** 2).astype("d")
+
+    return np.pad(disc, pad, mode="constant")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the drop shadow blur in pretty_plot")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[100, 300, 600],
+            help="Render resolutions to benchmark")
+    parser.add_argument("--size", type=float, default=5,
+            help="Size of the pie chart (inches)")
+    parser.add_argument("--sigma", type=float, default=35,
+            help="Shadow radius (points, see shade_axis)")
+    parser.add_argument("--number", type=int, default=3,
+            help="Number of timing runs (best is reported)")
+    args = parser.parse_args()
+
+    print "{0:>5} {1:>11} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format("dpi",
+            "pixels", "legacy (s)", "exact (s)", "error", "shadow (s)", "error")
+
+    for dpi in args.dpi:
+        alpha = pie_alpha(dpi, args.size, args.sigma)
+        sigma = args.sigma/72.*dpi
+        downsample = max(1, int(sigma*2) // SHADOW_WINDOW)
+
+        def best(f):
+            return min(timeit.repeat(f, number=1, repeat=args.number))
+
+        legacy = legacy_smooth2d(alpha, sigma)
+        exact = smooth2d(alpha, sigma)
+        shadow = smooth2d(alpha, sigma, downsample)
+
+        print "{0:5d} {1:11,} {2:10.3f} {3:10.3f} {4:10.2g} {5:10.3f} {6:10.2g}".format(dpi,
+                alpha.size,
+                best(lambda: legacy_smooth2d(alpha, sigma)),
+                best(lambda: smooth2d(alpha, sigma)),
+                np.abs(exact - legacy).max(),
+                best(lambda: smooth2d(alpha, sigma, downsample)),
+                np.abs(shadow - legacy).max())
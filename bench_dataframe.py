@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import argparse, timeit, pandas
+from datetime import datetime
+from response_stats import TIME_FORMAT, iter_experiments, experiment_rows, frame_from_rows
+
+def legacy_frame_from_rows(rows):
+    """Row-wise construction used by make_dataframe before vectorization
+    (per-trial strptime and df.apply for the derived columns)"""
+    rows = [r[:6] + [datetime.strptime(r[6], TIME_FORMAT),
+        datetime.strptime(r[7], TIME_FORMAT)] + r[8:] for r in rows]
+
+    cols = ("id", "exp_id", "base", "version", "grade_value",
+            "grade_category", "started", "ended", "response_duration",
+            "py_years", "prog_years", "age", "degree", "gender", "location")
+
+    df = pandas.DataFrame(rows, columns=cols)
+    df["duration"] = df.apply(lambda r: (r["ended"] - r["started"]).total_seconds(), axis=1)
+    df["response_percent"] = df.apply(lambda r: r["duration"] / float(r["response_duration"])
+        if r["response_duration"] > 0 else 0, axis=1)
+
+    df["common"] = df.grade_category.apply(lambda gc: "common" in gc)
+
+    return df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks derived column computation in make_dataframe")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("--scale", type=int, default=10,
+            help="Number of copies of the trials to benchmark with")
+    parser.add_argument("--number", type=int, default=3,
+            help="Number of timing runs (best is reported)")
+    args = parser.parse_args()
+
+    rows = []
+    for e in iter_experiments(args.xml_file):
+        rows.extend(experiment_rows(e))
+
+    rows = rows * args.scale
+    print "{0:,} rows".format(len(rows))
+
+    # Sanity check that both paths agree
+    pandas.testing.assert_frame_equal(legacy_frame_from_rows(rows[:1000]),
+            frame_from_rows(rows[:1000]).drop("code_lines", axis=1), check_dtype=False)
+
+    legacy = min(timeit.repeat(lambda: legacy_frame_from_rows(rows),
+        number=1, repeat=args.number))
+
+    vectorized = min(timeit.repeat(lambda: frame_from_rows(rows),
+        number=1, repeat=args.number))
+
+    print "Row-wise:   {0:.3f} s".format(legacy)
+    print "Vectorized: {0:.3f} s".format(vectorized)
+    print "Speed-up:   {0:.1f}x".format(legacy / vectorized)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+import sys, csv, argparse, numpy as np
+from tobii_store import open_store, iter_chunks, valid_mask
+
+# A detected fixation (times are in the sample timestamp units)
+FIXATION_DTYPE = np.dtype([
+    ("start", "<i8"),
+    ("end", "<i8"),
+    ("duration", "<i8"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("samples", "<i4")
+])
+
+# Tobii timestamps are in microseconds
+TIME_SCALE = 1e6
+
+# Samples read at a time from a gaze store
+CHUNK_SIZE = 1 << 20
+
+def make_fixations(t, x, y, starts, ends):
+    """Builds fixation records for sample runs [starts[i], ends[i])"""
+    fixations = np.zeros(len(starts), dtype=FIXATION_DTYPE)
+    if len(starts) == 0:
+        return fixations
+
+    counts = ends - starts
+    fixations["start"] = t[starts]
+    fixations["end"] = t[ends - 1]
+    fixations["duration"] = fixations["end"] - fixations["start"]
+    fixations["samples"] = counts
+
+    # Centroids from per-run sums (runs are disjoint and ordered). A zero is
+    # appended so runs may end at the last sample.
+    bounds = np.c_[starts, ends].ravel()
+    fixations["x"] = np.add.reduceat(np.r_[x, 0], bounds)[::2] / counts
+    fixations["y"] = np.add.reduceat(np.r_[y, 0], bounds)[::2] / counts
+
+    return fixations
+
+class StreamingDetector(object):
+    """Base class for fixation detectors that are fed consecutive chunks of
+    samples. Samples that may belong to an unfinished fixation are kept
+    until the next chunk (or flush), so memory is bounded by the chunk
+    size plus the longest fixation."""
+
+    def __init__(self, min_duration):
+        self.min_duration = min_duration
+        self.t = np.zeros(0, dtype=np.int64)
+        self.x = np.zeros(0, dtype=np.float64)
+        self.y = np.zeros(0, dtype=np.float64)
+
+    def feed(self, t, x, y):
+        """Adds a chunk of samples (timestamps and gaze points, with NaN for
+        missing gaze). Returns the fixations completed so far."""
+        t = np.r_[self.t, np.asarray(t, dtype=np.int64)]
+        x = np.r_[self.x, np.asarray(x, dtype=np.float64)]
+        y = np.r_[self.y, np.asarray(y, dtype=np.float64)]
+
+        starts, ends, keep = self.detect(t, x, y, final=False)
+        self.t, self.x, self.y = t[keep:], x[keep:], y[keep:]
+
+        return self.fixations(t, x, y, starts, ends)
+
+    def flush(self):
+        """Returns any fixation still in progress at the end of the samples"""
+        t, x, y = self.t, self.x, self.y
+        starts, ends, _ = self.detect(t, x, y, final=True)
+        self.t, self.x, self.y = t[:0], x[:0], y[:0]
+
+        return self.fixations(t, x, y, starts, ends)
+
+    def fixations(self, t, x, y, starts, ends):
+        fixations = make_fixations(t, x, y, starts, ends)
+        return fixations[fixations["duration"] >= self.min_duration]
+
+    def detect(self, t, x, y, final):
+        """Returns arrays of run starts and ends for complete fixations, and
+        the index of the first sample to keep for the next chunk"""
+        raise NotImplementedError()
+
+class VelocityDetector(StreamingDetector):
+    """Velocity-threshold (I-VT) fixation detection. Samples whose
+    point-to-point velocity is below threshold (pixels per second) are
+    fixation samples; runs of them lasting at least min_duration
+    (timestamp units) are fixations."""
+
+    def __init__(self, threshold, min_duration, time_scale=TIME_SCALE):
+        StreamingDetector.__init__(self, min_duration)
+        self.threshold = threshold
+        self.time_scale = time_scale
+
+    def detect(self, t, x, y, final):
+        n = len(t)
+        if n < 2:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), 0
+
+        # Velocity of each sample relative to the one before it
+        dt = np.diff(t) / float(self.time_scale)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            velocity = np.hypot(np.diff(x), np.diff(y)) / dt
+            slow = np.r_[False, velocity < self.threshold]
+
+        edges = np.diff(np.r_[0, slow.astype(np.int8), 0])
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        # The last run may continue into the next chunk; keep it (and the
+        # sample before it, for its first velocity)
+        keep = n - 1
+        if (not final) and (len(ends) > 0) and (ends[-1] == n):
+            keep = starts[-1] - 1
+            starts, ends = starts[:-1], ends[:-1]
+
+        return starts, ends, keep
+
+class DispersionDetector(StreamingDetector):
+    """Dispersion-threshold (I-DT) fixation detection. A fixation starts
+    with a window of at least min_duration (timestamp units) whose
+    dispersion, (max x - min x) + (max y - min y), is at most threshold
+    (pixels), and grows until the dispersion would exceed it."""
+
+    # Samples examined at a time when growing a fixation
+    GROW_SIZE = 64
+
+    def __init__(self, threshold, min_duration):
+        StreamingDetector.__init__(self, min_duration)
+        self.threshold = threshold
+
+    def window_dispersion(self, t, x, y, window_ends):
+        """Returns the dispersion of windows [i, window_ends[i]] for every
+        sample i (NaN if a window contains missing gaze)"""
+        n = len(t)
+        x_min, x_max, y_min, y_max = x.copy(), x.copy(), y.copy(), y.copy()
+        width = int((window_ends - np.arange(n)).max()) + 1 if n > 0 else 0
+
+        for d in range(1, width):
+            i = np.flatnonzero(window_ends[:n - d] >= np.arange(n - d) + d)
+            x_min[i] = np.minimum(x_min[i], x[i + d])
+            x_max[i] = np.maximum(x_max[i], x[i + d])
+            y_min[i] = np.minimum(y_min[i], y[i + d])
+            y_max[i] = np.maximum(y_max[i], y[i + d])
+
+        bounds = (x_min, x_max, y_min, y_max)
+        return (x_max - x_min) + (y_max - y_min), bounds
+
+    def grow(self, x, y, end, bounds):
+        """Grows a fixation window past end (inclusive) while its dispersion
+        stays within threshold. Returns the exclusive end of the window."""
+        x_min, x_max, y_min, y_max = bounds
+        n = len(x)
+        while end + 1 < n:
+            block = slice(end + 1, min(end + 1 + self.GROW_SIZE, n))
+            bx_min = np.minimum.accumulate(np.r_[x_min, x[block]])[1:]
+            bx_max = np.maximum.accumulate(np.r_[x_max, x[block]])[1:]
+            by_min = np.minimum.accumulate(np.r_[y_min, y[block]])[1:]
+            by_max = np.maximum.accumulate(np.r_[y_max, y[block]])[1:]
+
+            with np.errstate(invalid="ignore"):
+                too_wide = ~(((bx_max - bx_min) + (by_max - by_min)) <= self.threshold)
+            if too_wide.any():
+                return end + 1 + np.argmax(too_wide)
+
+            end = block.stop - 1
+            x_min, x_max, y_min, y_max = bx_min[-1], bx_max[-1], by_min[-1], by_max[-1]
+
+        return n
+
+    def detect(self, t, x, y, final):
+        n = len(t)
+        empty = np.zeros(0, dtype=int)
+        if n == 0:
+            return empty, empty, 0
+
+        # Smallest window starting at each sample that spans min_duration
+        window_ends = np.searchsorted(t, t + self.min_duration, side="left")
+        complete = window_ends < n
+        window_ends = np.minimum(window_ends, n - 1)
+
+        dispersion, bounds = self.window_dispersion(t, x, y, window_ends)
+        with np.errstate(invalid="ignore"):
+            candidates = np.flatnonzero(complete & (dispersion <= self.threshold))
+
+        starts, ends = [], []
+        pos = 0
+        keep = n
+        while True:
+            c = np.searchsorted(candidates, pos)
+            if c >= len(candidates):
+                # Windows that run past the chunk may still become fixations
+                incomplete = np.flatnonzero(~complete[pos:])
+                keep = pos + incomplete[0] if len(incomplete) > 0 else n
+                break
+
+            start = candidates[c]
+            end = self.grow(x, y, window_ends[start],
+                    [b[start] for b in bounds])
+
+            if (end == n) and (not final):
+                keep = start
+                break
+
+            starts.append(start)
+            ends.append(end)
+            pos = end
+
+        if final:
+            keep = n
+
+        return np.array(starts, dtype=int), np.array(ends, dtype=int), keep
+
+def detect_fixations(detector, chunks):
+    """Runs a detector over an iterable of (t, x, y) chunks and yields
+    arrays of fixations as they are completed"""
+    for t, x, y in chunks:
+        fixations = detector.feed(t, x, y)
+        if len(fixations) > 0:
+            yield fixations
+
+    fixations = detector.flush()
+    if len(fixations) > 0:
+        yield fixations
+
+def store_chunks(store_path, validmax=None, chunksize=CHUNK_SIZE):
+    """Yields (t, x, y) chunks from a gaze store. If validmax is given,
+    samples with a higher validity code sum have their gaze set to NaN."""
+    samples, _ = open_store(store_path)
+    for chunk in iter_chunks(samples, chunksize):
+        x = chunk["x"].astype(np.float64)
+        y = chunk["y"].astype(np.float64)
+        if validmax is not None:
+            invalid = ~valid_mask(chunk, validmax)
+            x[invalid] = np.nan
+            y[invalid] = np.nan
+
+        yield chunk["timestamp"], x, y
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detects fixations in a gaze sample store")
+    parser.add_argument("store", type=str, help="Path to gaze store (see tobii_store.py)")
+    parser.add_argument("-a", "--algorithm", type=str, choices=["ivt", "idt"], default="ivt",
+            help="Velocity (ivt) or dispersion (idt) threshold algorithm")
+    parser.add_argument("-t", "--threshold", type=float, default=None,
+            help="Velocity (pixels/s, default 1000) or dispersion (pixels, default 50) threshold")
+    parser.add_argument("-d", "--min-duration", type=float, default=100,
+            help="Minimum fixation duration in milliseconds")
+    parser.add_argument("-v", "--validmax", type=int, default=1,
+            help="Maximum valid code (Tobii recommends 1)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write fixations to a csv file instead of stdout")
+    args = parser.parse_args()
+
+    min_duration = int(args.min_duration * TIME_SCALE / 1000)
+    if args.algorithm == "ivt":
+        detector = VelocityDetector(args.threshold or 1000, min_duration)
+    else:
+        detector = DispersionDetector(args.threshold or 50, min_duration)
+
+    out_file = sys.stdout
+    if args.output is not None:
+        out_file = open(args.output, "wb")
+
+    try:
+        writer = csv.writer(out_file)
+        writer.writerow(FIXATION_DTYPE.names)
+        for fixations in detect_fixations(detector, store_chunks(args.store, args.validmax)):
+            writer.writerows(fixations.tolist())
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+import os, json, hashlib, argparse, numpy as np, pandas
+from pretty_plot import smooth2d, SHADOW_WINDOW
+from aoi import Layout, DEFAULT_LAYOUT, read_program, line_aois
+from tobii_align import TIME_SCALE, trial_intervals, experiment_rows, assign_trials, \
+        session_exp_ids, warn_overlaps
+from trial_cache import file_sha1
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot
+
+# Screen size (pixels) and size of a histogram bin
+SCREEN_SIZE = (1920, 1080)
+BIN_SIZE = 4
+
+# Blur radius (pixels) applied to summed histograms
+SIGMA = 20
+
+# Bump when the layout of cached grids changes
+GRID_VERSION = 1
+
+# Accumulation {{{
+
+def accumulate_grids(x, y, groups, n_groups, weights=None,
+        screen_size=SCREEN_SIZE, bin_size=BIN_SIZE):
+    """Bins points into one 2D histogram per group with a single bincount.
+    Returns an array with shape (n_groups, rows, columns); points off the
+    screen or without a group (-1) are dropped."""
+    cols = int(np.ceil(screen_size[0] / float(bin_size)))
+    rows = int(np.ceil(screen_size[1] / float(bin_size)))
+
+    with np.errstate(invalid="ignore"):
+        c = np.floor(np.asarray(x, dtype="d") / bin_size)
+        r = np.floor(np.asarray(y, dtype="d") / bin_size)
+        keep = (groups >= 0) & (c >= 0) & (c < cols) & (r >= 0) & (r < rows)
+
+    cells = (groups[keep] * (rows * cols)) + (r[keep].astype(np.int64) * cols) + \
+            c[keep].astype(np.int64)
+
+    if weights is not None:
+        weights = np.asarray(weights, dtype="d")[keep]
+
+    counts = np.bincount(cells, weights=weights, minlength=n_groups * rows * cols)
+    return counts.astype(np.float32).reshape(n_groups, rows, cols)
+
+def program_keys(trials):
+    """Returns the sorted (base, version) pairs of a trial table and the
+    group index of each trial"""
+    pairs = zip(trials["base"].astype(str), trials["version"].astype(str))
+    keys = sorted(set(pairs))
+    lookup = dict((k, i) for i, k in enumerate(keys))
+
+    return keys, np.array([lookup[p] for p in pairs], dtype=np.int64)
+
+def fixation_grids(fixations, starts, ends, trial_groups, n_groups,
+        weight="duration", screen_size=SCREEN_SIZE, bin_size=BIN_SIZE, rows=None):
+    """Accumulates fixations (with start, x, y and duration columns) into a
+    grid per program, using the trial (of rows, if given) whose interval
+    contains each fixation's start"""
+    trial_idx = assign_trials(fixations["start"].values.astype(np.int64), starts,
+            ends, rows)
+    groups = np.where(trial_idx >= 0, trial_groups[np.maximum(trial_idx, 0)], -1)
+    weights = fixations["duration"].values if weight == "duration" else None
+
+    return accumulate_grids(fixations["x"].values, fixations["y"].values,
+            groups, n_groups, weights, screen_size, bin_size)
+
+# }}}
+
+# Grid cache {{{
+
+def grid_cache_path(fixations_path):
+    return "{0}.heatmap.npz".format(fixations_path)
+
+def grid_key(fixations_path, keys, starts, ends, params, exp_id=None):
+    """Hashes everything a file's cached grids depend on"""
+    sha = hashlib.sha1(json.dumps([GRID_VERSION, file_sha1(fixations_path), keys,
+        params, exp_id]))
+    sha.update(starts.tostring())
+    sha.update(ends.tostring())
+
+    return sha.hexdigest()
+
+def file_grids(fixations_path, trials, starts, ends, params, use_cache=True,
+        exp_id=None):
+    """Returns the per-program grids (one per program_keys pair) for a
+    fixations csv file, using the grids cached next to it if the file,
+    trials and parameters haven't changed. If exp_id is given, fixations
+    are only assigned to that experiment's trials."""
+    keys, trial_groups = program_keys(trials)
+    cache_path = grid_cache_path(fixations_path)
+    key = grid_key(fixations_path, keys, starts, ends, params, exp_id)
+
+    if use_cache and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached["key"]) == key:
+            return cached["grids"]
+
+    fixations = pandas.read_csv(fixations_path)
+    rows = None if exp_id is None else experiment_rows(trials, exp_id)
+    grids = fixation_grids(fixations, starts, ends, trial_groups, len(keys),
+            params["weight"], params["screen_size"], params["bin_size"], rows)
+
+    if use_cache:
+        with open(cache_path, "wb") as cache_file:
+            np.savez_compressed(cache_file, key=np.array(key), grids=grids)
+
+    return grids
+
+# }}}
+
+# Rendering {{{
+
+def code_extent(code, layout, margin):
+    """Returns the (left, top, right, bottom) screen rectangle around a
+    program's text"""
+    lines = line_aois(code, layout)
+    return (lines["x0"].min() - margin, lines["y0"].min() - margin,
+            lines["x1"].max() + margin, lines["y1"].max() + margin)
+
+def blur_grid(grid, sigma, bin_size):
+    """Blurs a histogram once with the drop shadow filter's smoothing"""
+    sigma = sigma / float(bin_size)
+    return smooth2d(grid, sigma, max(1, int(sigma*2) // SHADOW_WINDOW))
+
+def render_heatmap(grid, base, version, layout=DEFAULT_LAYOUT, bin_size=BIN_SIZE,
+        sigma=SIGMA, margin=40, path=None):
+    """Draws a blurred gaze histogram under the text of a program"""
+    code = read_program(base, version)
+    heat = blur_grid(grid, sigma, bin_size)
+    left, top, right, bottom = code_extent(code, layout, margin)
+
+    # Crop to the code (in bins)
+    c0, c1 = max(0, int(left // bin_size)), int(np.ceil(right / float(bin_size)))
+    r0, r1 = max(0, int(top // bin_size)), int(np.ceil(bottom / float(bin_size)))
+    heat = heat[r0:r1, c0:c1]
+
+    dpi = 100.0
+    fig = pyplot.figure(figsize=((right - left) / dpi, (bottom - top) / dpi), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(heat, cmap="hot_r", interpolation="bilinear", aspect="auto",
+            extent=(c0 * bin_size, c1 * bin_size, r1 * bin_size, r0 * bin_size))
+
+    font_size = layout.line_height * 0.7 * 72 / dpi
+    for i, line in enumerate(code.rstrip("\n").split("\n")):
+        ax.text(layout.left, layout.top + ((i + 0.5) * layout.line_height), line,
+                family="monospace", size=font_size, va="center", ha="left")
+
+    ax.set_xlim(left, right)
+    ax.set_ylim(bottom, top)
+    ax.axis("off")
+
+    if path is None:
+        path = "plots/heatmap-{0}-{1}.png".format(base, version)
+
+    fig.savefig(path, dpi=dpi)
+    pyplot.close(fig)
+
+    return path
+
+# }}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders gaze heatmaps over the program stimuli")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("fixations", type=str, nargs="+",
+            help="Fixation csv files (see fixations.py)")
+    parser.add_argument("--screen", type=int, nargs=2, default=SCREEN_SIZE,
+            help="Screen width and height (pixels)")
+    parser.add_argument("--bin-size", type=int, default=BIN_SIZE,
+            help="Size of a histogram bin (pixels)")
+    parser.add_argument("--sigma", type=float, default=SIGMA,
+            help="Blur radius (pixels)")
+    parser.add_argument("--weight", type=str, choices=["duration", "count"], default="duration",
+            help="Weight fixations by duration or count them")
+    parser.add_argument("--time-scale", type=int, default=TIME_SCALE,
+            help="Fixation timestamp units per second")
+    parser.add_argument("--offset", type=int, default=0,
+            help="Fixation timestamp at 1970-01-01 00:00:00 in trial (local) time")
+    parser.add_argument("--left", type=float, default=DEFAULT_LAYOUT.left,
+            help="Screen x of the first character (pixels)")
+    parser.add_argument("--top", type=float, default=DEFAULT_LAYOUT.top,
+            help="Screen y of the first line (pixels)")
+    parser.add_argument("--char-width", type=float, default=DEFAULT_LAYOUT.char_width,
+            help="Width of a character (pixels)")
+    parser.add_argument("--line-height", type=float, default=DEFAULT_LAYOUT.line_height,
+            help="Height of a line (pixels)")
+    parser.add_argument("--exp-ids", type=int, nargs="+", default=None,
+            help="Experiment id of each fixation file, in order (fixations are only assigned to trials of that experiment)")
+    parser.add_argument("--no-cache", action="store_true",
+            help="Always re-parse the XML file (and its append log) instead of using the cached trial table")
+    parser.add_argument("--no-grid-cache", action="store_true",
+            help="Don't read or write cached grids")
+    args = parser.parse_args()
+    exp_ids = session_exp_ids(parser, args.fixations, args.exp_ids)
+
+    from trial_cache import load_trials
+    if args.no_cache:
+        trial_df = load_trials(args.xml_file, refresh=True, save=False)
+    else:
+        trial_df = load_trials(args.xml_file)
+
+    trials, starts, ends = trial_intervals(trial_df, args.time_scale, args.offset)
+    if args.exp_ids is None:
+        warn_overlaps(starts, ends)
+
+    params = { "weight": args.weight, "screen_size": list(args.screen),
+            "bin_size": args.bin_size }
+
+    # Sum the partial grids of every file
+    keys, _ = program_keys(trials)
+    total = None
+    for path, exp_id in zip(args.fixations, exp_ids):
+        grids = file_grids(path, trials, starts, ends, params, not args.no_grid_cache,
+                exp_id)
+        total = grids if total is None else (total + grids)
+
+    if not os.path.exists("plots"):
+        os.makedirs("plots")
+
+    layout = Layout(args.left, args.top, args.char_width, args.line_height)
+    for (base, version), grid in zip(keys, total):
+        if grid.sum() > 0:
+            print render_heatmap(grid, base, version, layout, args.bin_size, args.sigma)
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import argparse
-from io import StringIO
+import os, csv, sys, glob, gzip, json, argparse, multiprocessing
+from collections import namedtuple, OrderedDict
+from lxml import etree
 
 MATCH_EXACT = 3
 MATCH_LINES = 2
@@ -15,155 +16,397 @@ COMMON_EXACT = 4
 COMMON_LINES = 3
 COMMON_VALUES = 2
 
-def common_errors(base, version):
-    """Returns a list of common error responses for the given
-    program base and version"""
-    if base == "between":
-        return ["[8, 7, 9]\n[1, 0, 8, 1]\n[8]"]
-    elif base == "scope":
-        return ["22"]
-    elif base == "counting":
-        return ["The count is 1\nThe count is 2\nThe count is 3\nThe count is 4\nDone counting"]
-    elif base == "partition":
-        if version == "balanced":
-            return ["low\nlow\nhigh\nhigh"]
-        elif (version == "unbalanced") or (version == "unbalanced_pivot"):
-            return ["low\nlow\nhigh"]
-    elif base == "overload":
-        if version == "plusmixed":
-            return ["7\n9\n\"53\"", "7\n9\n8"]
-        elif version == "multmixed":
-            return ["12\n14\n8"]
-        elif version == "strings":
-            return ["hibye\nstreetpenny\n8"]
-    elif base == "funcall":
-        return ["-60", "0", "-80"]
-    elif base == "order":
-        return ["5 2 10"]
-    elif base == "whitespace":
-        return ["0 5\n1 10\n2 15"]
-    elif base == "initvar":
-        if version == "bothbad":
-            return ["0\n10"]
-        elif version == "good":
-            return ["1\n2\n3\n4\n1\n2\n3\n4"]
-        elif version == "onebad":
-            return ["24\n10"]
-    return []
+# Grading {{{
 
-def grade_string(expected, actual):
-    """Grades a single response against the true (actual) output.
-    Possible return values are:
-        * MATCH_EXACT (perfect match)
-        * MATCH_LINES (correct number of lines, non-formatting characters match)
-        * MATCH_VALUES (non-formatting characters match)
-        * MATCH_NONE (no match)"""
-    # Convert to universal newlines, strip extraneous whitespace
-    expected_io = StringIO(unicode(expected.strip()), newline=None)
-    actual_io = StringIO(unicode(actual.strip()), newline=None)
+# Characters that are ignored when matching values only
+FORMAT_CHARS = ['[', ']', ',', ' ', '\n', '"', '\'']
+FORMAT_TABLE = dict.fromkeys(map(ord, FORMAT_CHARS), None)
+
+# Pre-computed forms of an output string used for grading
+Normalized = namedtuple("Normalized", ["text", "lines", "values", "line_values"])
 
-    expected_str = expected_io.read()
-    actual_str = actual_io.read()
+def normalize_output(output):
+    """Computes the forms of an output string that are compared when
+    grading (universal newlines, stripped lines, and values with
+    formatting characters removed)"""
+    text = unicode(output.strip()).replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+    lines = tuple(line.strip() for line in text.split(u"\n")) if text else ()
+    return Normalized(text, lines, text.translate(FORMAT_TABLE).lower(),
+            tuple(line.translate(FORMAT_TABLE).lower() for line in lines))
 
+def grade_normalized(expected, actual):
+    """Grades a normalized response against a normalized true output.
+    See grade_string for possible return values."""
     # Pefect match
-    if expected_str == actual_str:
+    if expected.text == actual.text:
         return MATCH_EXACT
 
-    format_chars = ['[', ']', ',', ' ', '\n', '"', '\'']
-    table = dict.fromkeys(map(ord, format_chars), None)
-
-    expected_io.seek(0)
-    expected_lines = [line.strip() for line in expected_io.readlines()]
-    actual_io.seek(0)
-    actual_lines = [line.strip() for line in actual_io.readlines()]
+    actual_lines = actual.lines
+    actual_values = actual.line_values
 
     # Remove blank lines
     removed_blanks = False
 
-    if len(expected_lines) != len(actual_lines):
-        actual_lines = [line for line in actual_lines if len(line.strip()) > 0]
+    if len(expected.lines) != len(actual_lines):
+        keep = [i for i, line in enumerate(actual_lines) if len(line) > 0]
+        actual_lines = tuple(actual_lines[i] for i in keep)
+        actual_values = tuple(actual_values[i] for i in keep)
         removed_blanks = True
 
     # Check for line by line exact/partial match
-    if len(expected_lines) == len(actual_lines):
-        exact_match = True
-        partial_match = False
-
-        for (e_line, a_line) in zip(expected_lines, actual_lines):
-            if e_line != a_line:
-                exact_match = False
-                if (e_line.translate(table).lower() == a_line.translate(table).lower()):
-                    partial_match = True
-                else:
-                    partial_match = False
-                    break
-
-        if exact_match:
+    if len(expected.lines) == len(actual_lines):
+        if expected.lines == actual_lines:
             return MATCH_EXACT if not removed_blanks else MATCH_LINES
-        elif partial_match:
+        elif expected.line_values == actual_values:
             return MATCH_LINES
 
     # Check for partial match of values only
-    if expected_str.translate(table).lower() == actual_str.translate(table).lower():
+    if expected.values == actual.values:
         return MATCH_VALUES
 
     return MATCH_NONE
 
+def grade_string(expected, actual):
+    """Grades a single response against the true (actual) output.
+    Possible return values are:
+        * MATCH_EXACT (perfect match)
+        * MATCH_LINES (correct number of lines, non-formatting characters match)
+        * MATCH_VALUES (non-formatting characters match)
+        * MATCH_NONE (no match)"""
+    return grade_normalized(normalize_output(expected), normalize_output(actual))
+
+# }}}
+
+# Program rubrics {{{
+
+# Expected outputs are read from programs/output/<base>_<version>.py.txt
+PROGRAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+
+# Common errors by base and version ("*" matches any version)
+COMMON_ERRORS_FILE = "common_errors.json"
+
+# Expected output and common errors (raw and normalized) for a program
+Program = namedtuple("Program", ["expected", "errors",
+    "normalized_expected", "normalized_errors"])
+
+NO_PROGRAM = Program(None, [], None, [])
+
+def load_programs(programs_dir=PROGRAMS_DIR):
+    """Loads the expected output and common errors of every program into a
+    dictionary keyed by (base, version)"""
+    with open(os.path.join(programs_dir, COMMON_ERRORS_FILE), "r") as errors_file:
+        base_errors = json.load(errors_file)
+
+    expected = {}
+    for path in glob.glob(os.path.join(programs_dir, "output", "*.py.txt")):
+        name = os.path.basename(path)[:-len(".py.txt")]
+        with open(path, "r") as output_file:
+            expected[tuple(name.split("_", 1))] = output_file.read()
+
+    keys = set(expected.keys())
+    for base, version_errors in base_errors.iteritems():
+        keys.update((base, version) for version in version_errors)
+
+    programs = {}
+    for base, version in keys:
+        version_errors = base_errors.get(base, {})
+        errors = version_errors.get(version, version_errors.get("*", []))
+        output = expected.get((base, version))
+        programs[(base, version)] = Program(output, errors,
+                normalize_output(output) if output is not None else None,
+                [normalize_output(e) for e in errors])
+
+    return programs
+
+# Loaded on first use
+programs_table = None
+
+def get_program(base, version):
+    """Returns the Program for a base and version"""
+    global programs_table
+    if programs_table is None:
+        programs_table = load_programs()
+
+    program = programs_table.get((base, version))
+    if program is None:
+        program = programs_table.get((base, "*"), NO_PROGRAM)
+
+    return program
+
+def common_errors(base, version):
+    """Returns a list of common error responses for the given
+    program base and version"""
+    return get_program(base, version).errors
+
+def expected_output(base, version):
+    """Returns the true output of the given program base and version, or
+    None if it is unknown"""
+    return get_program(base, version).expected
+
+# }}}
+
+# Grade index {{{
+
+# Grade for a match against the true output (False) or a common error (True)
+MATCH_GRADES = {
+    (False, MATCH_EXACT): ("correct exact", CORRECT_EXACT),
+    (False, MATCH_LINES): ("correct lines", CORRECT_LINES),
+    (False, MATCH_VALUES): ("correct values", CORRECT_VALUES),
+    (True, MATCH_EXACT): ("common exact", COMMON_EXACT),
+    (True, MATCH_LINES): ("common lines", COMMON_LINES),
+    (True, MATCH_VALUES): ("common values", COMMON_VALUES)
+}
+
+class GradeIndex(object):
+    """Hash index from the normalized forms of a response to its grade for
+    one true output and list of common errors, with a bounded LRU cache
+    of raw responses in front so repeated responses aren't normalized again.
+
+    Like auto_grade, the true output is tried first and then each common
+    error in order, with the first target that matches (see
+    grade_normalized) determining the grade."""
+
+    def __init__(self, true_output, errors, cache_size=1024):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # Each index maps a form to the first target (0 = true output,
+        # 1+ = common errors) with that form
+        self.lines = {}
+        self.line_values = {}
+        self.values = {}
+
+        targets = [true_output] + list(errors)
+        for i in reversed(range(len(targets))):
+            target = targets[i]
+            self.lines[target.lines] = i
+            self.line_values[target.line_values] = i
+            self.values[target.values] = i
+
+    def match(self, response):
+        """Returns (target index, match) for a normalized response, or
+        (None, MATCH_NONE) if it doesn't match any target"""
+        hits = []
+        lines, line_values = response.lines, response.line_values
+
+        # Lines match only when the line counts agree (implied by equality)
+        i = self.lines.get(lines)
+        if i is not None:
+            hits.append((i, -MATCH_EXACT))
+
+        i = self.line_values.get(line_values)
+        if i is not None:
+            hits.append((i, -MATCH_LINES))
+
+        # Blank lines are removed only when the line counts differ, which is
+        # implied if the non-blank lines match
+        if u"" in lines:
+            keep = [j for j, line in enumerate(lines) if len(line) > 0]
+            for index, forms in ((self.lines, lines), (self.line_values, line_values)):
+                i = index.get(tuple(forms[j] for j in keep))
+                if i is not None:
+                    hits.append((i, -MATCH_LINES))
+
+        i = self.values.get(response.values)
+        if i is not None:
+            hits.append((i, -MATCH_VALUES))
+
+        if len(hits) == 0:
+            return None, MATCH_NONE
+
+        i, match = min(hits)
+        return i, -match
+
+    def grade(self, response):
+        """Returns (category, value) for a raw response string. Raises a
+        ValueError if the response must be graded manually."""
+        # Move to the back of the cache when found
+        grade = self.cache.pop(response, None)
+        if grade is None:
+            i, match = self.match(normalize_output(response))
+            if match == MATCH_NONE:
+                grade = False  # manual grade (cached too)
+            else:
+                grade = MATCH_GRADES[(i > 0, match)]
+
+        self.cache[response] = grade
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        if not grade:
+            raise ValueError("Invalid match value")
+
+        return grade
+
+# Grade indexes by (base, version, true output)
+grade_index_cache = {}
+
+def grade_index(base, version, true_output):
+    """Returns the (shared) grade index for a program base, version and
+    true output"""
+    key = (base, version, true_output)
+    index = grade_index_cache.get(key)
+    if index is None:
+        index = GradeIndex(normalize_output(true_output),
+                get_program(base, version).normalized_errors)
+        grade_index_cache[key] = index
+
+    return index
+
 def auto_grade(base, version, true_output, response):
     """Auto-grades a trial response against the true output. Response
     must either be correct or a common error (otherwise, a manual grade
     should have existed)"""
-    category = "unknown"
-    value = -1
-    match = grade_string(true_output, response)
-
-    # Try common errors
-    if match == MATCH_NONE:
-        for error_output in common_errors(base, version):
-            match = grade_string(error_output, response)
-            if match != MATCH_NONE:
-                break
-
-        # Common error
-        category = "common "
-        if match == MATCH_EXACT:
-            category += "exact"
-            value = COMMON_EXACT
-        elif match == MATCH_LINES:
-            category += "lines"
-            value = COMMON_LINES
-        elif match == MATCH_VALUES:
-            category += "values"
-            value = COMMON_VALUES
-        else:
-            raise ValueError("Invalid match value")
-    else:
-        # Correct answer
-        category = "correct "
-        if match == MATCH_EXACT:
-            category += "exact"
-            value = CORRECT_EXACT
-        elif match == MATCH_LINES:
-            category += "lines"
-            value = CORRECT_LINES
-        elif match == MATCH_VALUES:
-            category += "values"
-            value = CORRECT_VALUES
-        else:
-            raise ValueError("Invalid match value")
+    return grade_index(base, version, true_output).grade(response)
+
+# }}}
 
-    return category, value
+# Batch grading {{{
+
+def grade_trials(trials):
+    """Auto-grades a list of (id, base, version, true output, response)
+    tuples, where the id can be any key. Returns a list of (id, base,
+    version, category, value) tuples, with category "manual" for responses
+    that can't be auto-graded."""
+    grades = []
+    for id, base, version, true_output, response in trials:
+        try:
+            category, value = auto_grade(base, version, true_output, response)
+        except ValueError:
+            category, value = "manual", -1
+
+        grades.append((id, base, version, category, value))
+
+    return grades
+
+def iter_xml_trials(xml_path):
+    """Yields ((exp_id, id), base, version, true output, response) for
+    every <trial> in a (possibly gzipped) response data XML file or store
+    file (see response_store.py). Trial ids are only unique within an
+    experiment, so they are paired with the experiment's id."""
+    from response_store import STORE_EXT, load_store, iter_xml_experiments
+    if xml_path.endswith(STORE_EXT):
+        for e in iter_xml_experiments(load_store(xml_path)):
+            for t in e.iterfind("trials/trial"):
+                yield ((e.attrib["id"], t.attrib["id"]), t.attrib["base"], t.attrib["version"],
+                        t.findtext("true-output", ""), t.findtext("predicted-output", ""))
+        return
+
+    xml_file = gzip.open(xml_path, "rb") if xml_path.endswith(".gz") \
+            else open(xml_path, "rb")
+
+    with xml_file:
+        for _, e in etree.iterparse(xml_file, events=("end",), tag=("trial", "experiment")):
+            if e.tag == "trial":
+                # The experiment's start tag (and id) has already been parsed
+                exp_id = e.getparent().getparent().attrib["id"]
+                yield ((exp_id, e.attrib["id"]), e.attrib["base"], e.attrib["version"],
+                        e.findtext("true-output", ""), e.findtext("predicted-output", ""))
+
+            # Free the finished element and any siblings before it (trials
+            # within an experiment, then whole experiments)
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+
+def iter_csv_trials(csv_path):
+    """Yields (id, base, version, true output, response) for every row of a
+    CSV file with base, version, actual and (optionally) expected columns.
+    The id is taken from an id column if present, otherwise the row
+    number. Missing expected outputs are looked up by base and version;
+    rows without one can't be graded and are skipped (with a warning)."""
+    with open(csv_path, "rb") as csv_file:
+        for i, row in enumerate(csv.DictReader(csv_file)):
+            base, version = row["base"], row["version"]
+            expected = row.get("expected")
+            if not expected:
+                expected = expected_output(base, version)
+                if expected is None:
+                    print >>sys.stderr, "Skipping ungradable row {0}: no expected output for {1} {2}".format(
+                            row.get("id", i), base, version)
+                    continue
+
+            yield (row.get("id", i), base, version, expected, row["actual"])
+
+def chunked(items, size):
+    """Groups an iterable into lists of at most size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+def grade_batch(trials, processes=1, chunk_size=500):
+    """Auto-grades an iterable of (id, base, version, true output, response)
+    tuples, optionally fanning out over a process pool. Grades are
+    returned in the same order as the trials."""
+    chunks = chunked(trials, chunk_size)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap(grade_trials, chunks)
+            return [g for grades in results for g in grades]
+        finally:
+            pool.close()
+            pool.join()
+
+    return [g for chunk in chunks for g in grade_trials(chunk)]
+
+# }}}
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--base", type=str, required=True, help="Program base")
-    parser.add_argument("--version", type=str, required=True, help="Program version")
-    parser.add_argument("--expected", type=str, required=True, help="Path to expected output text file")
-    parser.add_argument("--actual", type=str, required=True, help="Path to actual output text file")
+    parser.add_argument("--base", type=str, help="Program base")
+    parser.add_argument("--version", type=str, help="Program version")
+    parser.add_argument("--expected", type=str,
+            help="Path to expected output text file (default: programs/output)")
+    parser.add_argument("--actual", type=str, help="Path to actual output text file")
+    parser.add_argument("--batch-xml", type=str, default=None,
+            help="Grade every trial in a response data XML (or store) file")
+    parser.add_argument("--batch-csv", type=str, default=None,
+            help="Grade every row of a CSV file with base, version, expected, actual columns")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+            help="Number of worker processes for batch grading")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write batch grades to a CSV file instead of stdout")
     args = parser.parse_args()
 
+    if (args.batch_xml is not None) or (args.batch_csv is not None):
+        if args.batch_xml is not None:
+            trials = iter_xml_trials(args.batch_xml)
+        else:
+            trials = iter_csv_trials(args.batch_csv)
+
+        out_file = sys.stdout
+        if args.output is not None:
+            out_file = open(args.output, "wb")
+
+        writer = csv.writer(out_file)
+        columns = ["base", "version", "grade_category", "grade_value"]
+        grades = grade_batch(trials, args.processes)
+        if args.batch_xml is not None:
+            writer.writerow(["exp_id", "id"] + columns)
+            writer.writerows(list(g[0]) + list(g[1:]) for g in grades)
+        else:
+            writer.writerow(["id"] + columns)
+            writer.writerows(grades)
+
+        sys.exit(0)
+
+    if None in (args.base, args.version, args.actual):
+        parser.error("--base, --version and --actual are required")
+
     response = open(args.actual, "r").read()
-    true_output = open(args.expected, "r").read()
+    if args.expected is not None:
+        true_output = open(args.expected, "r").read()
+    else:
+        true_output = expected_output(args.base, args.version)
+        if true_output is None:
+            parser.error("No expected output for {0} {1}".format(args.base, args.version))
 
     try:
         category, value = auto_grade(args.base, args.version, true_output, response)
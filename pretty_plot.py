@@ -24,15 +24,91 @@ def smooth1d(x, window_len):
     y=np.convolve(w/w.sum(),s,mode='same')
     return y[window_len-1:-window_len+1]
 
-def smooth2d(A, sigma=3):
+# Windows larger than this are convolved with FFTs instead of shifted sums
+FFT_WINDOW = 16
+
+# Shadows are blurred at reduced resolution so the window is about this wide
+SHADOW_WINDOW = 64
+
+def fft_size(n):
+    # smallest 2^a 3^b 5^c >= n
+    best = 1 << int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def smooth_rows(A, window_len):
+    # smooth1d applied to every row of A at once. Constant rows (like the
+    # padding around a shadow) are unchanged, so they are skipped.
+    flat = (A == A[:, :1]).all(axis=1)
+    if flat.any():
+        y = A.copy()
+        if not flat.all():
+            y[~flat] = smooth_rows(A[~flat], window_len)
+        return y
+
+    n = A.shape[-1]
+    h = (window_len - 1) // 2
+    s = np.concatenate([2*A[:, :1] - A[:, window_len:1:-1], A,
+        2*A[:, -1:] - A[:, -1:-window_len:-1]], axis=1)
+    w = np.hanning(window_len)
+    w = w / w.sum()
+
+    if window_len <= FFT_WINDOW:
+        y = np.zeros_like(A)
+        for j in range(window_len):
+            y += w[j] * s[:, h+j:h+j+n]
+        return y
+
+    size = fft_size(s.shape[1] + window_len - 1)
+    c = np.fft.irfft(np.fft.rfft(s, size, axis=1) * np.fft.rfft(w, size), size, axis=1)
+    return c[:, h+window_len-1:h+window_len-1+n]
+
+def downsample_mean(A, factor):
+    # block means of factor x factor pixels (edges are repeated to fill)
+    ny, nx = A.shape
+    py, px = -ny % factor, -nx % factor
+    A = np.pad(A, ((0, py), (0, px)), mode="edge")
+    return A.reshape(A.shape[0] // factor, factor,
+                     A.shape[1] // factor, factor).mean(axis=3).mean(axis=1)
+
+def upsample_linear(A, factor, shape):
+    # bilinear interpolation between block centers
+    def axis_weights(n, m):
+        pos = np.clip((np.arange(n) + 0.5) / factor - 0.5, 0, m - 1)
+        i0 = np.floor(pos).astype(int)
+        i1 = np.minimum(i0 + 1, m - 1)
+        return i0, i1, pos - i0
+
+    y0, y1, fy = axis_weights(shape[0], A.shape[0])
+    x0, x1, fx = axis_weights(shape[1], A.shape[1])
+    fy = fy[:, np.newaxis]
+    top = A[y0][:, x0] * (1 - fx) + A[y0][:, x1] * fx
+    bottom = A[y1][:, x0] * (1 - fx) + A[y1][:, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def smooth2d(A, sigma=3, downsample=1):
+    # smooth1d along rows and then columns of the whole array. With
+    # downsample > 1, the blur is done at reduced resolution and
+    # interpolated back up (much faster for large sigmas).
+    A = np.asarray(A, dtype="d")
+    if downsample > 1:
+        small = smooth2d(downsample_mean(A, downsample), sigma / float(downsample))
+        return upsample_linear(small, downsample, A.shape)
 
     window_len = max(int(sigma), 3)*2+1
-    A1 = np.array([smooth1d(x, window_len) for x in np.asarray(A)])
-    A2 = np.transpose(A1)
-    A3 = np.array([smooth1d(x, window_len) for x in A2])
-    A4 = np.transpose(A3)
+    A1 = smooth_rows(A, window_len)
+    A2 = smooth_rows(A1.T, window_len)
 
-    return A4
+    return A2.T
 
 class BaseFilter(object):
     def prepare_image(self, src_image, dpi, pad):
@@ -84,8 +160,9 @@ class GaussianFilter(BaseFilter):
     def process_image(self, padded_src, dpi):
         #offsetx, offsety = int(self.offsets[0]), int(self.offsets[1])
         tgt_image = np.zeros_like(padded_src)
-        aa = smooth2d(padded_src[:,:,-1]*self.alpha,
-                      self.sigma/72.*dpi)
+        sigma = self.sigma/72.*dpi
+        aa = smooth2d(padded_src[:,:,-1]*self.alpha, sigma,
+                      max(1, int(sigma*2) // SHADOW_WINDOW))
         tgt_image[:,:,-1] = aa
         tgt_image[:,:,:-1] = self.color
         return tgt_image
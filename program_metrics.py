@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+import os, sys, ast, glob, json, math, hashlib, keyword, tokenize, argparse, pandas
+from cStringIO import StringIO
+
+# Stimulus programs are programs/<base>_<version>.py with their true output
+# in programs/output/<base>_<version>.py.txt
+PROGRAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+
+# Computed metrics are cached here, keyed by file content hashes
+CACHE_FILE = ".metrics.json"
+
+# Bump when metric definitions change (invalidates the cache)
+METRICS_VERSION = 1
+
+# Metric names used in the response data XML and their column names
+METRIC_COLUMNS = [
+    ("code chars", "code_chars"),
+    ("code lines", "code_lines"),
+    ("cyclomatic complexity", "cyclomatic_complexity"),
+    ("halstead effort", "halstead_effort"),
+    ("halstead volume", "halstead_volume"),
+    ("output chars", "output_chars"),
+    ("output lines", "output_lines")
+]
+
+# Nodes that add a path through a program (functions count as one too)
+DECISION_NODES = (ast.If, ast.IfExp, ast.For, ast.While, ast.ExceptHandler,
+        ast.comprehension, ast.FunctionDef)
+
+# Metrics {{{
+
+def cyclomatic_complexity(code):
+    """McCabe's cyclomatic complexity of a whole program: 1 plus the number
+    of branches, loops and function definitions"""
+    tree = ast.parse(code)
+    return 1 + sum(1 for n in ast.walk(tree) if isinstance(n, DECISION_NODES))
+
+def halstead(code):
+    """Returns the Halstead (volume, effort) of a program. Operators are
+    punctuation, keywords and indentation changes (counted as a single
+    operator); operands are names, numbers and strings."""
+    operators = []
+    operands = []
+    for kind, text, _, _, _ in tokenize.generate_tokens(StringIO(code).readline):
+        if kind == tokenize.OP:
+            operators.append(text)
+        elif kind == tokenize.NAME:
+            if keyword.iskeyword(text):
+                operators.append(text)
+            else:
+                operands.append(text)
+        elif kind in (tokenize.INDENT, tokenize.DEDENT):
+            operators.append("<indent>")
+        elif kind in (tokenize.NUMBER, tokenize.STRING):
+            operands.append(text)
+
+    n1, n2 = len(set(operators)), len(set(operands))
+    N1, N2 = len(operators), len(operands)
+    if (n1 + n2) < 2 or n2 == 0:
+        return 0.0, 0.0
+
+    volume = (N1 + N2) * math.log(n1 + n2, 2)
+    difficulty = (n1 / 2.0) * (N2 / float(n2))
+
+    return volume, difficulty * volume
+
+def code_metrics(code):
+    """Computes the static metrics of a program's source code"""
+    volume, effort = halstead(code)
+    return {
+        "code_chars": len(code),
+        "code_lines": code.count("\n"),
+        "cyclomatic_complexity": cyclomatic_complexity(code),
+        "halstead_effort": effort,
+        "halstead_volume": volume
+    }
+
+def output_metrics(output):
+    """Computes the metrics of a program's true output"""
+    return {
+        "output_chars": len(output),
+        "output_lines": len(output.splitlines())
+    }
+
+# }}}
+
+# Cache {{{
+
+def program_files(programs_dir=PROGRAMS_DIR):
+    """Returns a dictionary with the (code path, output path) of each
+    program by (base, version)"""
+    files = {}
+    for code_path in sorted(glob.glob(os.path.join(programs_dir, "*.py"))):
+        name = os.path.basename(code_path)[:-3]
+        base, version = name.split("_", 1)
+        output_path = os.path.join(programs_dir, "output", name + ".py.txt")
+        files[(base, version)] = (code_path, output_path)
+
+    return files
+
+def read_cache(cache_path):
+    """Reads cached metrics, returning an empty cache if it is missing,
+    unreadable or from another version"""
+    try:
+        with open(cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+    if cache.get("version") != METRICS_VERSION:
+        return {}
+
+    return cache.get("programs", {})
+
+def write_cache(cache_path, programs):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump({ "version": METRICS_VERSION, "programs": programs },
+                cache_file, indent=2, sort_keys=True)
+
+    os.rename(tmp_path, cache_path)
+
+def read_text(path):
+    """Returns the contents of a file and their SHA-1 hex digest (None for
+    both if the file is missing)"""
+    if not os.path.exists(path):
+        return None, None
+
+    with open(path, "rb") as in_file:
+        text = in_file.read()
+
+    return text, hashlib.sha1(text).hexdigest()
+
+def update_metrics(programs_dir=PROGRAMS_DIR, cache_path=None, refresh=False,
+        write=True):
+    """Computes the metrics of every program, reusing cached values for
+    programs (and outputs) whose contents haven't changed. The cache is
+    only updated if write is True. Returns a dictionary of metrics by
+    (base, version) and the number of programs that were (re)computed."""
+    if cache_path is None:
+        cache_path = os.path.join(programs_dir, CACHE_FILE)
+
+    cache = {} if refresh else read_cache(cache_path)
+    programs = {}
+    metrics = {}
+    computed = 0
+
+    for (base, version), (code_path, output_path) in program_files(programs_dir).iteritems():
+        name = "{0}_{1}".format(base, version)
+        code, code_sha1 = read_text(code_path)
+        output, output_sha1 = read_text(output_path)
+
+        entry = cache.get(name, {})
+        if entry.get("code_sha1") != code_sha1:
+            entry = { "code_sha1": code_sha1, "code": code_metrics(code) }
+            computed += 1
+
+        if (entry.get("output_sha1") != output_sha1) or ("output" not in entry):
+            entry["output_sha1"] = output_sha1
+            entry["output"] = output_metrics(output) if output is not None else {}
+
+        programs[name] = entry
+        metrics[(base, version)] = dict(entry["code"], **entry["output"])
+
+    if write and (programs != cache):
+        try:
+            write_cache(cache_path, programs)
+        except (IOError, OSError):
+            pass  # Read-only programs directory
+
+    return metrics, computed
+
+def load_metrics(programs_dir=PROGRAMS_DIR, cache_path=None, refresh=False,
+        write=True):
+    """Returns a data frame of program metrics indexed by (base, version)"""
+    metrics, _ = update_metrics(programs_dir, cache_path, refresh, write)
+    index = pandas.MultiIndex.from_tuples(sorted(metrics.keys()),
+            names=["base", "version"])
+
+    columns = [c for _, c in METRIC_COLUMNS]
+    rows = [[metrics[k].get(c) for c in columns] for k in index]
+
+    return pandas.DataFrame(rows, index=index, columns=columns)
+
+metrics_table = None
+
+def joined_metrics():
+    """Returns the metrics table used by join_metrics. It is loaded once,
+    without writing the programs/ cache (loading trials shouldn't touch
+    the programs directory)."""
+    global metrics_table
+    if metrics_table is None:
+        metrics_table = load_metrics(write=False)
+
+    return metrics_table
+
+def metrics_sha1():
+    """Hashes the metrics table used by join_metrics, so that caches of
+    joined trial data can tell when programs/ changed"""
+    table = joined_metrics()
+    return hashlib.sha1(json.dumps([METRICS_VERSION, list(table.index),
+        table.columns.tolist(), table.values.tolist()])).hexdigest()
+
+def join_metrics(df, columns=None):
+    """Adds program metric columns to a trial data frame by (base, version).
+    Programs missing from programs/ get NaN metrics and are reported on
+    stderr."""
+    table = joined_metrics()
+    if columns is None:
+        columns = table.columns
+
+    pairs = set(zip(df["base"], df["version"]))
+    missing = sorted(pairs - set(table.index))
+    if len(missing) > 0:
+        print >>sys.stderr, "No program in programs/ for {0} (metrics will be NaN)".format(
+                ", ".join("{0}_{1}".format(*k) for k in missing))
+
+    keys = pandas.MultiIndex.from_arrays([df["base"], df["version"]])
+    for c in columns:
+        values = table[c].reindex(keys)
+        df[c] = values.values if values.notnull().all() else values.astype(float).values
+
+    return df
+
+# }}}
+
+def xml_metrics(xml_path):
+    """Reads the (first) metrics of each program from a response data file"""
+    from response_stats import iter_experiments
+
+    metrics = {}
+    for e in iter_experiments(xml_path):
+        for t in e.iterfind("trials/trial"):
+            key = (t.attrib["base"], t.attrib["version"])
+            if key not in metrics:
+                metrics[key] = dict((m.attrib["name"], float(m.attrib["value"]))
+                        for m in t.iterfind("metrics/metric"))
+
+    return metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Computes (and caches) static metrics of the stimulus programs")
+    parser.add_argument("--programs", type=str, default=PROGRAMS_DIR,
+            help="Directory with program sources")
+    parser.add_argument("--refresh", action="store_true",
+            help="Recompute metrics for every program")
+    parser.add_argument("--compare", type=str, default=None,
+            help="Response data XML file to compare metrics with")
+    args = parser.parse_args()
+
+    metrics, computed = update_metrics(args.programs, refresh=args.refresh)
+    print "{0} programs ({1} computed)".format(len(metrics), computed)
+
+    if args.compare is None:
+        print load_metrics(args.programs).to_string()
+    else:
+        # Report metrics that differ from the ones in the XML file
+        for key, values in sorted(xml_metrics(args.compare).iteritems()):
+            if key not in metrics:
+                print "{0}_{1}: missing program".format(*key)
+                continue
+
+            for name, column in METRIC_COLUMNS:
+                if (name in values) and (column in metrics[key]) and \
+                        abs(values[name] - metrics[key][column]) > 1e-6:
+                    print "{0}_{1}: {2} = {3} (XML: {4})".format(key[0], key[1],
+                            name, metrics[key][column], values[name])
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import argparse, itertools, multiprocessing, numpy as np, pandas
+
+# Trial columns compared between versions of a program
+METRICS = ("grade_value", "duration")
+
+# Statistics that can be compared (must accept an axis argument)
+STATISTICS = {
+    "mean": np.mean,
+    "median": np.median
+}
+
+# Resamples drawn at once (each is a row of an index matrix)
+BATCH_SIZE = 1000
+
+# Resampling {{{
+
+def batch_random(seed, key, batch):
+    """Returns the random generator for one batch of one comparison. Seeds
+    depend only on (seed, comparison, batch), so results are the same no
+    matter how batches are spread over processes."""
+    return np.random.RandomState([seed, key, batch])
+
+def bootstrap_batch(a, b, size, rs, statistic="mean"):
+    """Returns size bootstrap replicates of statistic(a) - statistic(b),
+    resampling each group with replacement"""
+    stat = STATISTICS[statistic]
+    idx_a = rs.randint(0, len(a), size=(size, len(a)))
+    idx_b = rs.randint(0, len(b), size=(size, len(b)))
+
+    return stat(a[idx_a], axis=1) - stat(b[idx_b], axis=1)
+
+def permutation_batch(a, b, size, rs, statistic="mean"):
+    """Returns size replicates of statistic(a) - statistic(b) with the
+    group labels randomly permuted"""
+    stat = STATISTICS[statistic]
+    pooled = np.r_[a, b]
+    perms = rs.rand(size, len(pooled)).argsort(axis=1)
+    groups = pooled[perms]
+
+    return stat(groups[:, :len(a)], axis=1) - stat(groups[:, len(a):], axis=1)
+
+def resample_batch(task):
+    """Runs one batch of resamples: (kind, a, b, size, statistic, seed,
+    key, batch), where kind is "bootstrap" or "permutation" """
+    kind, a, b, size, statistic, seed, key, batch = task
+    rs = batch_random(seed, key, batch)
+    if kind == "bootstrap":
+        return bootstrap_batch(a, b, size, rs, statistic)
+
+    return permutation_batch(a, b, size, rs, statistic)
+
+def batch_sizes(resamples, batch_size=BATCH_SIZE):
+    """Splits a number of resamples into batches of at most batch_size"""
+    sizes = [batch_size] * (resamples // batch_size)
+    if resamples % batch_size > 0:
+        sizes.append(resamples % batch_size)
+
+    return sizes
+
+def resample_tasks(comparisons, resamples, statistic="mean", seed=0,
+        batch_size=BATCH_SIZE):
+    """Yields bootstrap and permutation batches for a list of (a, b)
+    comparisons"""
+    for i, (a, b) in enumerate(comparisons):
+        for j, kind in enumerate(("bootstrap", "permutation")):
+            # Each comparison and kind gets its own random streams
+            key = (i * 2) + j
+            for batch, size in enumerate(batch_sizes(resamples, batch_size)):
+                yield (kind, a, b, size, statistic, seed, key, batch)
+
+def compare_groups(comparisons, resamples=10000, statistic="mean", ci=0.95,
+        seed=0, processes=1, batch_size=BATCH_SIZE):
+    """Computes a bootstrap confidence interval and two-sided permutation
+    test p-value for statistic(a) - statistic(b) of each (a, b) array pair.
+    Returns a list of (difference, ci low, ci high, p-value) tuples."""
+    comparisons = [(np.asarray(a, dtype="d"), np.asarray(b, dtype="d"))
+            for a, b in comparisons]
+
+    tasks = list(resample_tasks(comparisons, resamples, statistic, seed, batch_size))
+    if (processes > 1) and (len(tasks) > 1):
+        pool = multiprocessing.Pool(processes)
+        try:
+            replicates = pool.map(resample_batch, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        replicates = map(resample_batch, tasks)
+
+    # Gather batches by comparison and kind (tasks are in order)
+    batches = {}
+    for task, values in zip(tasks, replicates):
+        batches.setdefault(task[6], []).append(values)
+
+    stat = STATISTICS[statistic]
+    alpha = (1 - ci) / 2.0
+    results = []
+    for key, (a, b) in enumerate(comparisons):
+        observed = stat(a) - stat(b)
+        boot = np.concatenate(batches[key * 2])
+        perm = np.concatenate(batches[key * 2 + 1])
+
+        low, high = np.percentile(boot, [100 * alpha, 100 * (1 - alpha)])
+        extreme = np.count_nonzero(np.abs(perm) >= abs(observed) - 1e-12)
+        p_value = (extreme + 1) / float(len(perm) + 1)
+        results.append((observed, low, high, p_value))
+
+    return results
+
+# }}}
+
+def version_comparisons(df, metrics=METRICS):
+    """Yields (base, version a, version b, metric, a values, b values) for
+    every pair of versions of each program base"""
+    groups = dict(((str(b), str(v)), g) for (b, v), g in
+            df.groupby(["base", "version"], observed=True))
+
+    bases = sorted(set(b for b, _ in groups))
+    for base in bases:
+        versions = sorted(v for b, v in groups if b == base)
+        for v_a, v_b in itertools.combinations(versions, 2):
+            for metric in metrics:
+                yield (base, v_a, v_b, metric,
+                        groups[(base, v_a)][metric].values,
+                        groups[(base, v_b)][metric].values)
+
+def version_report(df, metrics=METRICS, **kwargs):
+    """Compares every pair of versions of each program base on metrics.
+    Returns a data frame with a row per comparison (keyword arguments are
+    passed to compare_groups)."""
+    comparisons = list(version_comparisons(df, metrics))
+    results = compare_groups([(a, b) for _, _, _, _, a, b in comparisons], **kwargs)
+
+    statistic = STATISTICS[kwargs.get("statistic", "mean")]
+    rows = []
+    for (base, v_a, v_b, metric, a, b), result in zip(comparisons, results):
+        rows.append([base, v_a, v_b, metric, len(a), len(b),
+            statistic(a), statistic(b)] + list(result))
+
+    cols = ("base", "version_a", "version_b", "metric", "n_a", "n_b",
+            "value_a", "value_b", "difference", "ci_low", "ci_high", "p_value")
+
+    return pandas.DataFrame(rows, columns=cols)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bootstrap confidence intervals and permutation tests for differences between program versions")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("-n", "--resamples", type=int, default=10000,
+            help="Number of bootstrap/permutation resamples per comparison")
+    parser.add_argument("--statistic", type=str, choices=sorted(STATISTICS.keys()),
+            default="mean", help="Statistic to compare between versions")
+    parser.add_argument("--ci", type=float, default=0.95,
+            help="Confidence level of bootstrap intervals")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Random seed (results don't depend on the number of processes)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+            help="Resamples drawn at once")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of worker processes (default: number of cores)")
+    parser.add_argument("--no-cache", action="store_true",
+            help="Always re-parse the XML file (and its append log) instead of using the cached trial table")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write the report to a csv file instead of stdout")
+    args = parser.parse_args()
+
+    from trial_cache import load_trials
+    if args.no_cache:
+        trial_df = load_trials(args.xml_file, refresh=True, save=False)
+    else:
+        trial_df = load_trials(args.xml_file)
+
+    report = version_report(trial_df, resamples=args.resamples,
+            statistic=args.statistic, ci=args.ci, seed=args.seed,
+            processes=args.processes or multiprocessing.cpu_count(),
+            batch_size=args.batch_size)
+
+    if args.output is None:
+        pandas.set_option("display.width", 200)
+        print report.to_string(index=False)
+    else:
+        report.to_csv(args.output, index=False)
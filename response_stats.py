@@ -1,8 +1,8 @@
 #!/usr/bin/env python
-import os, argparse, pandas
+import os, gzip, json, hashlib, argparse, multiprocessing, pandas
 from lxml import etree
-from datetime import datetime
 from pretty_plot import shade_axis
+from program_metrics import join_metrics
 
 import matplotlib
 matplotlib.use("Agg")
@@ -26,72 +26,175 @@ colors = [
 
 # Utility functions {{{
 
-def make_dataframe(experiments):
-    """Converts XML experiments into a data frame with a row for each trial"""
-    rows = []
-    for e in experiments:
-        exp_id = int(e.attrib["id"])
-        age = int(e.xpath(".//question[@name='age']/text()")[0])
-        degree = e.xpath(".//question[@name='education']/text()")[0]
-        gender = e.xpath(".//question[@name='gender']/text()")[0]
-        py_years = float(e.xpath(".//question[@name='python_years']/text()")[0])
-        prog_years = float(e.xpath(".//question[@name='programming_years']/text()")[0])
-        location = e.attrib["location"]
-
-        for t in e.xpath(".//trial"):
-            id = int(t.attrib["id"])
-            base = t.attrib["base"]
-            version = t.attrib["version"]
-
-            grade_category = t.attrib["grade-category"]
-            grade_value = int(t.attrib["grade-value"])
-
-            started = datetime.strptime(t.attrib["started"], TIME_FORMAT)
-            ended = datetime.strptime(t.attrib["ended"], TIME_FORMAT)
-            response_duration = float(t.attrib["response-duration"])
-
-            code_lines = int(t.xpath(".//metric[@name='code lines']/@value")[0])
-
-            rows.append([id, exp_id, base, version, grade_value, grade_category,
-                started, ended, response_duration, py_years, prog_years, age,
-                degree, gender, location, code_lines])
-
+def open_xml(xml_path):
+    """Opens a response data XML file, decompressing it if it ends in .gz"""
+    if xml_path.endswith(".gz"):
+        return gzip.open(xml_path, "rb")
+
+    return open(xml_path, "rb")
+
+def parse_experiments(xml_file):
+    """Yields XML experiments one at a time from an open response data file.
+    Each experiment is cleared after it has been consumed, so memory use
+    does not grow with the size of the file."""
+    for _, e in etree.iterparse(xml_file, events=("end",), tag="experiment"):
+        yield e
+
+        # Free the finished experiment and any siblings before it
+        e.clear()
+        while e.getprevious() is not None:
+            del e.getparent()[0]
+
+def iter_experiments(xml_path):
+    """Yields XML experiments one at a time from a (possibly gzipped)
+    response data file, or a store file (see response_store.py)"""
+    from response_store import STORE_EXT, load_store, iter_xml_experiments
+    if xml_path.endswith(STORE_EXT):
+        for e in iter_xml_experiments(load_store(xml_path)):
+            yield e
+        return
+
+    with open_xml(xml_path) as xml_file:
+        for e in parse_experiments(xml_file):
+            yield e
+
+def experiment_rows(e):
+    """Yields a data frame row for each trial in an XML experiment"""
+    exp_id = int(e.attrib["id"])
+    answers = dict((q.attrib["name"], q.text) for q in e.iterfind("questions/question"))
+    age = int(answers["age"])
+    degree = answers["education"]
+    gender = answers["gender"]
+    py_years = float(answers["python_years"])
+    prog_years = float(answers["programming_years"])
+    location = e.attrib["location"]
+
+    for t in e.iterfind("trials/trial"):
+        id = int(t.attrib["id"])
+        base = t.attrib["base"]
+        version = t.attrib["version"]
+
+        grade_category = t.attrib["grade-category"]
+        grade_value = int(t.attrib["grade-value"])
+
+        # Timestamps are parsed in bulk by frame_from_rows
+        started = t.attrib["started"]
+        ended = t.attrib["ended"]
+        response_duration = float(t.attrib["response-duration"])
+
+        # Program metrics are joined in by frame_from_rows
+        yield [id, exp_id, base, version, grade_value, grade_category,
+            started, ended, response_duration, py_years, prog_years, age,
+            degree, gender, location]
+
+def frame_from_rows(rows):
+    """Builds the trial data frame (with derived columns) from rows
+    produced by experiment_rows"""
     cols = ("id", "exp_id", "base", "version", "grade_value",
             "grade_category", "started", "ended", "response_duration",
-            "py_years", "prog_years", "age", "degree", "gender", "location",
-            "code_lines")
+            "py_years", "prog_years", "age", "degree", "gender", "location")
 
     df = pandas.DataFrame(rows, columns=cols)
+    join_metrics(df, columns=["code_lines"])
+    df["started"] = pandas.to_datetime(df["started"], format=TIME_FORMAT)
+    df["ended"] = pandas.to_datetime(df["ended"], format=TIME_FORMAT)
 
     # Derived columns
-    df["duration"] = df.apply(lambda r: (r["ended"] - r["started"]).total_seconds(), axis=1)
-    df["response_percent"] = df.apply(lambda r: r["duration"] / float(r["response_duration"])
-        if r["response_duration"] > 0 else 0, axis=1)
+    df["duration"] = (df["ended"] - df["started"]).dt.total_seconds()
+    response_duration = df["response_duration"]
+    df["response_percent"] = (df["duration"] /
+            response_duration.where(response_duration > 0)).fillna(0)
 
-    df["common"] = df.grade_category.apply(lambda gc: "common" in gc)
+    df["common"] = df["grade_category"].str.contains("common", regex=False)
 
     return df
 
+def make_dataframe(experiments):
+    """Converts XML experiments into a data frame with a row for each trial"""
+    rows = []
+    for e in experiments:
+        rows.extend(experiment_rows(e))
+
+    return frame_from_rows(rows)
+
+def read_dataframe(xml_path):
+    """Streams a response data XML file (optionally gzipped) into a data
+    frame with a row for each trial. Equivalent to make_dataframe, but
+    without loading the whole document into memory. Store files (see
+    response_store.py) are loaded directly."""
+    from response_store import STORE_EXT, read_store_dataframe
+    if xml_path.endswith(STORE_EXT):
+        return read_store_dataframe(xml_path)
+
+    rows = []
+    for e in iter_experiments(xml_path):
+        rows.extend(experiment_rows(e))
+
+    return frame_from_rows(rows)
+
 # }}}
 
 # Plotting {{{
 
-def response_times(df, base, versions, threshold=300):
+# Grade bins for pie charts (summary columns and labels)
+GRADE_BINS = [
+    ("perfect", "Perfect"),
+    ("correct", "Correct"),
+    ("incorrect", "Incorrect"),
+    ("common_error", "Common Error")
+]
+
+# Longest response time (seconds) included in response time plots
+RESPONSE_THRESHOLD = 300
+
+def program_summary(df, threshold=RESPONSE_THRESHOLD):
+    """Summarizes trials by program base and version with a single groupby:
+    the number of trials in each grade bin, and the count, mean and
+    standard deviation of response times up to threshold seconds"""
+    grade_value = df["grade_value"]
+    perfect = grade_value == 10
+    correct = ~perfect & (grade_value >= 7)
+    common_error = ~perfect & ~correct & df["common"]
+
+    parts = pandas.DataFrame({
+        "base": df["base"],
+        "version": df["version"],
+        "perfect": perfect,
+        "correct": correct,
+        "incorrect": ~(perfect | correct | common_error),
+        "common_error": common_error,
+        "response_time": df["duration"].where(df["duration"] <= threshold)
+    })
+
+    groups = parts.groupby(["base", "version"], observed=True)
+    summary = groups[[c for c, _ in GRADE_BINS]].sum().astype(int)
+    summary["trials"] = groups.size()
+    summary["response_count"] = groups["response_time"].count()
+    summary["response_mean"] = groups["response_time"].mean()
+    summary["response_std"] = groups["response_time"].std()
+
+    summary = summary.reset_index()
+    summary["base"] = summary["base"].astype(str)
+    summary["version"] = summary["version"].astype(str)
+
+    # Categorical groups are in category order
+    return summary.sort_values(["base", "version"]).reset_index(drop=True)
+
+def response_times(df, summary, base, versions, threshold=RESPONSE_THRESHOLD):
     """Boxplot of response times for different versions of a program"""
-    rows = []
-    for v in versions:
-        v_rows = df[(df["base"] == base) & (df["version"] == v)]
-        for _, row in v_rows.iterrows():
-            duration = row["duration"]
-            if duration <= threshold:
-                rows.append([v, duration])
-
-    resp_df = pandas.DataFrame(rows, columns=("version", "response_time"))
-    x_labels = []
-    for v, v_df in resp_df.groupby("version"):
-        x_labels.append("{0}\n({1})".format(v, len(v_df)))
-        print "{0} - mean: {1}, std: {2}".format(v,
-            v_df.response_time.mean(), v_df.response_time.std())
+    resp_df = df[(df["base"] == base) & df["version"].isin(versions) &
+            (df["duration"] <= threshold)]
+
+    resp_df = pandas.DataFrame({
+        "version": resp_df["version"].astype(str),
+        "response_time": resp_df["duration"]
+    })
+
+    b_summary = summary[(summary["base"] == base) & (summary["response_count"] > 0) &
+            summary["version"].isin(versions)].sort_values("version")
+
+    x_labels = ["{0}\n({1})".format(v, n) for v, n in
+            zip(b_summary["version"], b_summary["response_count"])]
 
     # Plot
     ax = resp_df.boxplot(column="response_time", by="version", figsize=(10, 5))
@@ -104,38 +207,21 @@ def response_times(df, base, versions, threshold=300):
     fig.tight_layout()
     fig.savefig("plots/response_times-{0}.png".format(base))
 
-def grade_pie(df, base, versions):
+def grade_pie(summary, base, versions):
     """Pie chart of grade distribution for all versions of a program"""
-    perfect = 0
-    correct = 0
-    common_error = 0
-    incorrect = 0
-
     fig = pyplot.figure(figsize=(len(versions) * 5, 5))
     for i, v in enumerate(versions):
-        v_rows = df[(df["base"] == base) & (df["version"] == v)]
+        v_summary = summary[(summary["base"] == base) & (summary["version"] == v)]
         ax = fig.add_subplot(1, len(versions), i + 1)
         ax.set_title(v)
-        for _, row in v_rows.iterrows():
-            grade_category = row["grade_category"]
-            grade_value = int(row["grade_value"])
-
-            if grade_value == 10:
-                perfect += 1
-            elif grade_value >= 7:
-                correct += 1
-            elif "common" in grade_category:
-                common_error += 1
-            else:
-                incorrect += 1
-
-        bins = [perfect, correct, incorrect, common_error]
+
+        bins = [int(v_summary[c].sum()) for c, _ in GRADE_BINS]
         patches, _, _ = ax.pie(bins, autopct="%1.1f%%", shadow=False, colors=colors)
         shade_axis(ax)
 
     #fig.suptitle(base)
     pyplot.tight_layout()
-    pyplot.legend(patches, ["Perfect", "Correct", "Incorrect", "Common Error"],
+    pyplot.legend(patches, [label for _, label in GRADE_BINS],
             loc="lower left", ncol=2)
 
     pyplot.savefig("plots/grade_pie-{0}.png".format(base))
@@ -225,21 +311,137 @@ def grade_vs_experience(df):
 
 # }}}
 
+# Plot rendering {{{
+
+# Bump when the plotting code changes so cached plots are re-rendered
+PLOT_VERSION = 2
+
+# Hashes of the data behind each rendered plot
+PLOT_CACHE_FILE = "plots/.plot_cache.json"
+
+# Per-program plots
+PROGRAM_PLOTS = {
+    "grade_pie": grade_pie,
+    "response_times": response_times
+}
+
+def plot_path(kind, base):
+    """Returns the path of a program plot (plots/<kind>-<base>.png)"""
+    return "plots/{0}-{1}.png".format(kind, base)
+
+def plot_hash(kind, frames, params):
+    """Hashes a plot's type, input data frames and parameters"""
+    # json (unlike repr) doesn't distinguish str and unicode parameters
+    sha = hashlib.sha1(json.dumps([PLOT_VERSION, kind, params,
+        [list(df.columns) for df in frames]]))
+
+    for df in frames:
+        sha.update(pandas.util.hash_pandas_object(df, index=False).values.tostring())
+
+    return sha.hexdigest()
+
+def program_plot_tasks(df, summary, threshold=RESPONSE_THRESHOLD):
+    """Yields a (kind, path, data frames, params) task for each plot of
+    each program base in a summary (see program_summary)"""
+    durations = df.loc[df["duration"] <= threshold, ["base", "version", "duration"]]
+    durations = dict((str(b), b_df) for b, b_df in durations.groupby("base", observed=True))
+
+    for b, b_summary in summary.groupby("base", sort=True):
+        vs = sorted(b_summary["version"])
+        yield ("grade_pie", plot_path("grade_pie", b), (b_summary,), (b, vs))
+
+        b_durations = durations.get(b, df.loc[[], ["base", "version", "duration"]])
+        yield ("response_times", plot_path("response_times", b),
+                (b_durations, b_summary), (b, vs, threshold))
+
+def render_plot(task):
+    """Renders a single plot task, returning its path"""
+    kind, path, frames, params = task
+    PROGRAM_PLOTS[kind](*(tuple(frames) + tuple(params)))
+    pyplot.close("all")
+
+    return path
+
+def read_plot_cache(cache_path=PLOT_CACHE_FILE):
+    """Reads the plot hashes by path, or returns {} if they are missing"""
+    try:
+        with open(cache_path, "r") as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+def write_plot_cache(hashes, cache_path=PLOT_CACHE_FILE):
+    """Writes the plot hashes by path (atomically)"""
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(hashes, cache_file, indent=2, sort_keys=True)
+
+    os.rename(tmp_path, cache_path)
+
+def render_plots(tasks, processes=None, force=False, cache_path=PLOT_CACHE_FILE):
+    """Renders plot tasks in a process pool, skipping plots whose data and
+    parameters are unchanged since they were last rendered. Returns the
+    paths of the rendered plots."""
+    hashes = {} if force else read_plot_cache(cache_path)
+    pending = []
+    new_hashes = {}
+
+    for task in tasks:
+        kind, path, frames, params = task
+        h = plot_hash(kind, frames, params)
+        if (hashes.get(path) != h) or (not os.path.exists(path)):
+            pending.append(task)
+            new_hashes[path] = h
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    rendered = []
+    try:
+        if (processes > 1) and (len(pending) > 1):
+            pool = multiprocessing.Pool(min(processes, len(pending)))
+            try:
+                for path in pool.imap_unordered(render_plot, pending):
+                    rendered.append(path)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in pending:
+                rendered.append(render_plot(task))
+    finally:
+        # Remember the plots that made it, even if one failed
+        for path in rendered:
+            hashes[path] = new_hashes[path]
+
+        write_plot_cache(hashes, cache_path)
+
+    return rendered
+
+# }}}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("--no-cache", action="store_true",
+            help="Always re-parse the XML file (and its append log) instead of using the cached trial table")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of worker processes for plotting (default: number of cores)")
+    parser.add_argument("--force", action="store_true",
+            help="Re-render all program plots, even if their data hasn't changed")
     args = parser.parse_args()
 
     if not os.path.exists("plots"):
         os.makedirs("plots")
 
-    # Parse in XML
-    root = etree.parse(args.xml_file)
-    experiments = root.xpath("//experiment")
-    print "{0} experiments".format(len(experiments))
+    # Stream XML into a data frame (or load it from the cache)
+    from trial_cache import load_trials
+    if args.no_cache:
+        trial_df = load_trials(args.xml_file, refresh=True, save=False)
+    else:
+        trial_df = load_trials(args.xml_file)
 
-    # Convert to data frame
-    trial_df = make_dataframe(experiments)
+    print "{0} experiments".format(trial_df.exp_id.nunique())
     print "{0} trials".format(len(trial_df))
 
     exp_df = trial_df.drop_duplicates("exp_id")
@@ -259,20 +461,14 @@ if __name__ == "__main__":
     grade_vs_experience(trial_df)
     demographics(exp_df)
 
-    # Gather all program bases/versions
-    bases = {}
-    for _, row in trial_df.drop_duplicates(("base", "version")).iterrows():
-        b = row["base"]
-        v = row["version"]
-
-        if not b in bases:
-            bases[b] = set()
+    # Summarize all program bases/versions at once
+    summary = program_summary(trial_df)
 
-        bases[b].add(v)
+    print "\nResponse times (up to {0} s)".format(RESPONSE_THRESHOLD)
+    print summary[["base", "version", "response_count", "response_mean",
+        "response_std"]].to_string(index=False)
 
-    # Make individual program plots
-    for b, vs in sorted(bases.iteritems(), key=lambda kv: kv[0]):
-        print "Plotting {0}".format(b)
-        vs = sorted(vs)
-        grade_pie(trial_df, b, vs)
-        response_times(trial_df, b, vs)
+    # Make individual program plots (one task per base and plot type)
+    tasks = list(program_plot_tasks(trial_df, summary))
+    rendered = render_plots(tasks, args.processes, args.force)
+    print "Rendered {0} of {1} program plots".format(len(rendered), len(tasks))
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+import os, gzip, json, time, calendar, argparse, tempfile, itertools, \
+        numpy as np, pandas
+from datetime import datetime
+from collections import OrderedDict, defaultdict
+from lxml import etree
+from response_stats import TIME_FORMAT, open_xml, iter_experiments, frame_from_rows
+
+STORE_EXT = ".store.npz"
+
+# Bump when the layout of store files changes
+STORE_VERSION = 1
+
+# Attributes stored as numbers when every value round-trips exactly (all
+# other attributes are interned strings)
+ATTRIBUTE_KINDS = {
+    "id": "int",
+    "order": "int",
+    "grade-value": "int",
+    "started": "time",
+    "ended": "time",
+    "auto-graded": "bool"
+}
+
+# Child elements of experiments and trials (in order)
+EXPERIMENT_CHILDREN = ["questions", "trials"]
+TRIAL_CHILDREN = ["metrics", "true-output", "predicted-output"]
+
+# Integer arrays other than attribute columns (see README)
+TABLE_ARRAYS = ["experiments.answers", "experiments.trials", "answers.name",
+        "answers.value", "trials.program", "trials.predicted_output",
+        "programs.base", "programs.version", "programs.true_output",
+        "programs.metrics", "metrics.name", "metrics.value"]
+
+# Strings and attributes {{{
+
+class StringTable(object):
+    """Interns strings, giving each distinct string an integer code"""
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def intern(self, s):
+        """Returns the code of a string (-1 for None)"""
+        if s is None:
+            return -1
+
+        code = self.codes.get(s)
+        if code is None:
+            code = len(self.strings)
+            self.codes[s] = code
+            self.strings.append(s)
+
+        return code
+
+def native(s):
+    """Returns ASCII strings as str, like lxml does"""
+    try:
+        return s.encode("ascii")
+    except UnicodeError:
+        return s
+
+def parse_value(text, kind):
+    if kind == "int":
+        return int(text)
+    elif kind == "time":
+        return calendar.timegm(datetime.strptime(text, TIME_FORMAT).timetuple())
+    elif kind == "bool":
+        return ["False", "True"].index(text)
+
+    raise ValueError("Unknown kind: {0}".format(kind))
+
+def format_value(value, kind):
+    if kind == "int":
+        return str(value)
+    elif kind == "time":
+        return datetime.utcfromtimestamp(value).strftime(TIME_FORMAT)
+    elif kind == "bool":
+        return "True" if value else "False"
+
+    raise ValueError("Unknown kind: {0}".format(kind))
+
+def encode_column(texts, kind, strings):
+    """Encodes attribute values as numbers of the given kind if they all
+    round-trip exactly, and as string codes otherwise. Returns the kind
+    used and an array of values."""
+    if (kind != "str") and (None not in texts):
+        try:
+            values = [parse_value(t, kind) for t in texts]
+            if all(format_value(v, kind) == t for v, t in itertools.izip(values, texts)):
+                return kind, np.array(values, dtype=np.int64)
+        except ValueError:
+            pass
+
+    return "str", np.array([strings.intern(t) for t in texts], dtype=np.int32)
+
+def add_attributes(layouts, columns, table, elem):
+    """Appends the attributes of an element to the columns of a table. All
+    elements of a table must have the same attributes in the same order."""
+    names = elem.keys()
+    if table not in layouts:
+        layouts[table] = names
+    elif names != layouts[table]:
+        raise ValueError("Unsupported {0} attributes: {1}".format(table, ", ".join(names)))
+
+    for name, value in elem.items():
+        columns[table][name].append(value)
+
+def check_children(elem, tags):
+    if [c.tag for c in elem] != tags:
+        raise ValueError("Unsupported {0} element with children: {1}".format(elem.tag,
+            ", ".join(str(c.tag) for c in elem)))
+
+# }}}
+
+# XML to store {{{
+
+def root_element(xml_path):
+    """Returns the tag and attributes of a response data file's root"""
+    with open_xml(xml_path) as xml_file:
+        for _, elem in etree.iterparse(xml_file, events=("start",)):
+            return elem.tag, elem.items()
+
+def read_xml(xml_path):
+    """Streams a response data XML file into store tables. Returns a
+    dictionary of arrays (see README). Raises a ValueError for documents
+    the store can't represent exactly."""
+    strings = StringTable()
+    layouts = OrderedDict()
+    columns = { "experiments": defaultdict(list), "trials": defaultdict(list) }
+    arrays = defaultdict(list)
+    programs = {}
+
+    for e in iter_experiments(xml_path):
+        add_attributes(layouts, columns, "experiments", e)
+        check_children(e, EXPERIMENT_CHILDREN)
+
+        questions = e.find("questions")
+        for q in questions:
+            if (q.keys() != ["name"]) or (len(q) > 0):
+                raise ValueError("Unsupported question element")
+
+            arrays["answers.name"].append(strings.intern(q.get("name")))
+            arrays["answers.value"].append(strings.intern(q.text))
+
+        trials = e.find("trials")
+        for t in trials:
+            add_attributes(layouts, columns, "trials", t)
+            check_children(t, TRIAL_CHILDREN)
+
+            metrics = []
+            for m in t.find("metrics"):
+                if (m.keys() != ["name", "value"]) or (len(m) > 0):
+                    raise ValueError("Unsupported metric element")
+                metrics.append((m.get("name"), m.get("value")))
+
+            # Programs are stored once per distinct metrics and true output
+            program = (t.get("base"), t.get("version"), tuple(metrics),
+                    t.findtext("true-output"))
+
+            if program not in programs:
+                programs[program] = len(programs)
+                arrays["programs.base"].append(strings.intern(program[0]))
+                arrays["programs.version"].append(strings.intern(program[1]))
+                arrays["programs.true_output"].append(strings.intern(program[3]))
+                arrays["programs.metrics"].append(len(metrics))
+                for name, value in metrics:
+                    arrays["metrics.name"].append(strings.intern(name))
+                    arrays["metrics.value"].append(strings.intern(value))
+
+            arrays["trials.program"].append(programs[program])
+            arrays["trials.predicted_output"].append(strings.intern(t.findtext("predicted-output")))
+
+        arrays["experiments.answers"].append(len(questions))
+        arrays["experiments.trials"].append(len(trials))
+
+    store = dict((k, np.array(arrays[k], dtype=np.int32)) for k in TABLE_ARRAYS)
+    meta = { "version": STORE_VERSION, "root": root_element(xml_path) }
+
+    for table, t_columns in columns.iteritems():
+        layout = []
+        for name in layouts.get(table, []):
+            kind, values = encode_column(t_columns[name], ATTRIBUTE_KINDS.get(name, "str"), strings)
+            store["{0}.{1}".format(table, name)] = values
+            layout.append([name, kind])
+
+        meta[table] = layout
+
+    store["meta"] = meta
+    store["strings"] = strings.strings
+
+    return store
+
+# }}}
+
+# Store files {{{
+
+def save_store(store, store_path):
+    """Writes store tables to a compressed numpy archive. Strings are kept
+    in one UTF-8 buffer with character offsets."""
+    strings = [unicode(s) for s in store["strings"]]
+    arrays = dict((k, v) for k, v in store.iteritems() if k not in ("meta", "strings"))
+    arrays["meta"] = np.frombuffer(json.dumps(store["meta"]), dtype=np.uint8)
+    arrays["strings.data"] = np.frombuffer(u"".join(strings).encode("utf-8"), dtype=np.uint8)
+    arrays["strings.offsets"] = np.cumsum([0] + [len(s) for s in strings], dtype=np.int64)
+
+    tmp_path = store_path + ".tmp"
+    with open(tmp_path, "wb") as store_file:
+        np.savez_compressed(store_file, **arrays)
+
+    os.rename(tmp_path, store_path)
+
+def load_store(store_path):
+    """Reads store tables from a file written by save_store"""
+    with np.load(store_path) as archive:
+        store = dict((k, archive[k]) for k in archive.files)
+
+    meta = json.loads(store.pop("meta").tostring())
+    if meta.get("version") != STORE_VERSION:
+        raise ValueError("Unsupported store version: {0}".format(meta.get("version")))
+
+    data = store.pop("strings.data").tostring().decode("utf-8")
+    offsets = store.pop("strings.offsets")
+    store["meta"] = meta
+    store["strings"] = [native(data[a:b]) for a, b in itertools.izip(offsets[:-1], offsets[1:])]
+
+    return store
+
+def string_array(store):
+    """Returns the interned strings as an array, with None for code -1"""
+    return np.array(store["strings"] + [None], dtype=object)
+
+def attribute_texts(store, table, strings):
+    """Returns the (name, texts) of each attribute column of a table"""
+    columns = []
+    for name, kind in store["meta"][table]:
+        values = store["{0}.{1}".format(table, name)]
+        if kind == "str":
+            columns.append((name, strings[values]))
+        else:
+            columns.append((name, [format_value(v, kind) for v in values.tolist()]))
+
+    return columns
+
+# }}}
+
+# Store to XML {{{
+
+def indent(elem, level):
+    """Indents the children of an element like lxml's pretty_print, leaving
+    the text of leaf elements alone"""
+    if len(elem) > 0:
+        elem.text = "\n" + ("  " * (level + 1))
+        for child in elem:
+            indent(child, level + 1)
+            child.tail = "\n" + ("  " * (level + 1))
+
+        child.tail = "\n" + ("  " * level)
+
+def output_element(parent, tag, text):
+    elem = etree.SubElement(parent, tag)
+    if text is not None:
+        elem.text = etree.CDATA(text) if "]]>" not in text else text
+
+    return elem
+
+def set_attributes(elem, columns, row):
+    for name, texts in columns:
+        if texts[row] is not None:
+            elem.set(name, texts[row])
+
+def iter_xml_experiments(store):
+    """Yields the store's experiments as (indented) XML elements"""
+    strings = string_array(store)
+    exp_columns = attribute_texts(store, "experiments", strings)
+    trial_columns = attribute_texts(store, "trials", strings)
+
+    # Start of each experiment's answers and trials, and each program's metrics
+    answer_starts = np.r_[0, np.cumsum(store["experiments.answers"])]
+    trial_starts = np.r_[0, np.cumsum(store["experiments.trials"])]
+    metric_starts = np.r_[0, np.cumsum(store["programs.metrics"])]
+
+    for i in xrange(len(trial_starts) - 1):
+        e = etree.Element("experiment")
+        set_attributes(e, exp_columns, i)
+
+        questions = etree.SubElement(e, "questions")
+        for a in xrange(answer_starts[i], answer_starts[i + 1]):
+            q = etree.SubElement(questions, "question", name=strings[store["answers.name"][a]])
+            q.text = strings[store["answers.value"][a]]
+
+        trials = etree.SubElement(e, "trials")
+        for j in xrange(trial_starts[i], trial_starts[i + 1]):
+            t = etree.SubElement(trials, "trial")
+            set_attributes(t, trial_columns, j)
+
+            p = store["trials.program"][j]
+            metrics = etree.SubElement(t, "metrics")
+            for m in xrange(metric_starts[p], metric_starts[p + 1]):
+                etree.SubElement(metrics, "metric", OrderedDict([
+                    ("name", strings[store["metrics.name"][m]]),
+                    ("value", strings[store["metrics.value"][m]])]))
+
+            output_element(t, "true-output", strings[store["programs.true_output"][p]])
+            output_element(t, "predicted-output", strings[store["trials.predicted_output"][j]])
+
+        indent(e, 1)
+        yield e
+
+def write_xml(store, xml_path):
+    """Writes a store as a response data XML file (gzipped if the path ends
+    in .gz), one experiment at a time"""
+    out_file = gzip.open(xml_path, "wb") if xml_path.endswith(".gz") else open(xml_path, "wb")
+    try:
+        tag, attributes = store["meta"]["root"]
+        with etree.xmlfile(out_file, encoding="UTF-8") as xf:
+            xf.write_declaration()
+            with xf.element(tag, OrderedDict(attributes)):
+                previous = None
+                for e in iter_xml_experiments(store):
+                    if previous is None:
+                        xf.write("\n  ")
+                    else:
+                        previous.tail = "\n  "
+                        xf.write(previous)
+
+                    previous = e
+
+                if previous is not None:
+                    previous.tail = "\n"
+                    xf.write(previous)
+
+        out_file.write("\n")
+    finally:
+        out_file.close()
+
+def same_documents(path_a, path_b):
+    """Returns True if two response data files parse to the same root and
+    experiments (including whitespace inside experiments)"""
+    if root_element(path_a) != root_element(path_b):
+        return False
+
+    experiments = itertools.izip_longest(iter_experiments(path_a), iter_experiments(path_b))
+    for a, b in experiments:
+        if (a is None) or (b is None) or \
+                (etree.tostring(a, with_tail=False) != etree.tostring(b, with_tail=False)):
+            return False
+
+    return True
+
+def xml_to_store(xml_path, store_path, check=True):
+    """Converts a response data XML file to a store file. If check is True,
+    the store is converted back and compared with the original first."""
+    store = read_xml(xml_path)
+    if check:
+        fd, tmp_path = tempfile.mkstemp(suffix=".xml")
+        os.close(fd)
+        try:
+            write_xml(store, tmp_path)
+            if not same_documents(xml_path, tmp_path):
+                raise ValueError("{0} can't be stored without loss".format(xml_path))
+        finally:
+            os.remove(tmp_path)
+
+    save_store(store, store_path)
+    return store
+
+# }}}
+
+# Trial data frame {{{
+
+def typed_column(store, table, name, strings, parse):
+    """Returns the values of an attribute column, parsing string-coded
+    columns with parse"""
+    values = store["{0}.{1}".format(table, name)]
+    kind = dict(store["meta"][table])[name]
+    if kind == "str":
+        return np.array([parse(s) for s in strings[values]])
+    elif kind == "time":
+        return pandas.to_datetime(values, unit="s")
+
+    return values
+
+def answer_column(store, name, strings):
+    """Returns each experiment's answer to a question (the last one if it
+    was asked more than once)"""
+    n_exp = len(store["experiments.trials"])
+    exp_idx = np.repeat(np.arange(n_exp), store["experiments.answers"])
+    asked = store["answers.name"] == strings.tolist().index(name)
+
+    answers = np.full(n_exp, -1, dtype=np.int64)
+    answers[exp_idx[asked]] = store["answers.value"][asked]
+    if (answers < 0).any():
+        raise ValueError("Missing answers to {0}".format(name))
+
+    return strings[answers]
+
+def store_dataframe(store):
+    """Builds the trial data frame from store tables directly (the same
+    frame as response_stats.read_dataframe)"""
+    strings = string_array(store)
+    exp_idx = np.repeat(np.arange(len(store["experiments.trials"])),
+            store["experiments.trials"])
+
+    def experiment_values(values):
+        return np.asarray(values)[exp_idx]
+
+    def parse_time(text):
+        return datetime.strptime(text, TIME_FORMAT)
+
+    answers = dict((name, answer_column(store, name, strings)) for name in
+            ("age", "education", "gender", "python_years", "programming_years"))
+
+    rows = pandas.DataFrame(OrderedDict([
+        ("id", typed_column(store, "trials", "id", strings, int)),
+        ("exp_id", experiment_values(typed_column(store, "experiments", "id", strings, int))),
+        ("base", strings[store["trials.base"]]),
+        ("version", strings[store["trials.version"]]),
+        ("grade_value", typed_column(store, "trials", "grade-value", strings, int)),
+        ("grade_category", strings[store["trials.grade-category"]]),
+        ("started", typed_column(store, "trials", "started", strings, parse_time)),
+        ("ended", typed_column(store, "trials", "ended", strings, parse_time)),
+        ("response_duration", strings[store["trials.response-duration"]].astype(float)),
+        ("py_years", experiment_values(answers["python_years"].astype(float))),
+        ("prog_years", experiment_values(answers["programming_years"].astype(float))),
+        ("age", experiment_values(answers["age"].astype(int))),
+        ("degree", experiment_values(answers["education"])),
+        ("gender", experiment_values(answers["gender"])),
+        ("location", experiment_values(strings[store["experiments.location"]]))
+    ]))
+
+    return frame_from_rows(rows)
+
+def read_store_dataframe(store_path):
+    return store_dataframe(load_store(store_path))
+
+# }}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts between response data XML files and normalized store files ({0})".format(STORE_EXT))
+    parser.add_argument("input", type=str, help="Response data XML file (optionally gzipped) or store file")
+    parser.add_argument("output", type=str, help="Store file, or XML file when converting a store")
+    parser.add_argument("--no-check", action="store_true",
+            help="Don't verify that the store converts back to the same XML")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.input.endswith(STORE_EXT):
+        store = load_store(args.input)
+        write_xml(store, args.output)
+    else:
+        store = xml_to_store(args.input, args.output, not args.no_check)
+
+    print "{0} experiments, {1} trials, {2} programs, {3} strings".format(
+            len(store["experiments.trials"]), len(store["trials.program"]),
+            len(store["programs.base"]), len(store["strings"]))
+
+    print "{0} ({1:,} bytes) -> {2} ({3:,} bytes) in {4:.2f}s".format(args.input,
+            os.path.getsize(args.input), args.output, os.path.getsize(args.output),
+            time.time() - start)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+import os, sys, json, shutil, hashlib, argparse, tempfile, threading, \
+        subprocess, multiprocessing
+from program_metrics import PROGRAMS_DIR, program_files, read_text
+
+# Outputs are cached here, keyed by program source hashes
+CACHE_FILE = ".outputs.json"
+
+# Bump when the way programs are run changes (invalidates the cache)
+RUN_VERSION = 1
+
+# Seconds a program may run before it is killed
+TIMEOUT = 10
+
+# Limits for each program (seconds of CPU, bytes of memory)
+CPU_LIMIT = 30
+MEMORY_LIMIT = 1 << 30
+
+# Running programs {{{
+
+def limit_resources():
+    """Caps CPU time and memory of a program (POSIX only)"""
+    try:
+        import resource
+    except ImportError:
+        return
+
+    resource.setrlimit(resource.RLIMIT_CPU, (CPU_LIMIT, CPU_LIMIT))
+    resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT, MEMORY_LIMIT))
+
+def run_program(task):
+    """Runs a program (name, source, interpreter, timeout) from a copy in an
+    empty temporary directory, with no stdin and a minimal environment, and
+    kills it after timeout seconds. Returns (name, exit code, stdout,
+    stderr, timed out)."""
+    name, code, interpreter, timeout = task
+    run_dir = tempfile.mkdtemp(prefix="eyecode-")
+    try:
+        path = os.path.join(run_dir, name + ".py")
+        with open(path, "wb") as code_file:
+            code_file.write(code)
+
+        env = { "PATH": os.environ.get("PATH", ""), "HOME": run_dir,
+                "PYTHONHASHSEED": "0", "PYTHONIOENCODING": "utf-8" }
+
+        with open(os.devnull, "rb") as null_file:
+            process = subprocess.Popen([interpreter, "-E", "-s", "-B", path],
+                    cwd=run_dir, env=env, stdin=null_file, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, close_fds=True,
+                    preexec_fn=limit_resources if os.name == "posix" else None)
+
+            timed_out = []
+            def kill():
+                timed_out.append(True)
+                process.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                stdout, stderr = process.communicate()
+            finally:
+                timer.cancel()
+
+        return name, process.returncode, stdout, stderr, len(timed_out) > 0
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def run_key(code, interpreter):
+    """Hashes everything a program's output depends on"""
+    return hashlib.sha1(json.dumps([RUN_VERSION, interpreter]) + code).hexdigest()
+
+# }}}
+
+# Cache {{{
+
+def read_cache(cache_path):
+    """Reads cached outputs, returning an empty cache if it is missing,
+    unreadable or from another version"""
+    try:
+        with open(cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+    if cache.get("version") != RUN_VERSION:
+        return {}
+
+    return cache.get("programs", {})
+
+def write_cache(cache_path, programs):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump({ "version": RUN_VERSION, "programs": programs },
+                cache_file, indent=2, sort_keys=True)
+
+    os.rename(tmp_path, cache_path)
+
+def run_programs(programs_dir=PROGRAMS_DIR, interpreter=sys.executable,
+        timeout=TIMEOUT, processes=1, refresh=False, cache_path=None):
+    """Runs every program whose source (or interpreter) changed since it was
+    last run, in parallel. Returns a dictionary of cache entries (key,
+    exit code, stdout, stderr, timed out) by (base, version) and the number
+    of programs that were run."""
+    if cache_path is None:
+        cache_path = os.path.join(programs_dir, CACHE_FILE)
+
+    cache = {} if refresh else read_cache(cache_path)
+    programs = {}
+    tasks = []
+    keys = {}
+
+    for (base, version), (code_path, _) in program_files(programs_dir).iteritems():
+        name = "{0}_{1}".format(base, version)
+        code, _ = read_text(code_path)
+        keys[name] = run_key(code, interpreter)
+
+        # Timeouts may be due to load, so they are retried
+        entry = cache.get(name, {})
+        if (entry.get("key") == keys[name]) and not entry.get("timed_out"):
+            programs[name] = entry
+        else:
+            tasks.append((name, code, interpreter, timeout))
+
+    if (processes > 1) and (len(tasks) > 1):
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(run_program, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_program, tasks)
+
+    for name, returncode, stdout, stderr, timed_out in results:
+        programs[name] = { "key": keys[name], "returncode": returncode,
+                "stdout": stdout.decode("utf-8"), "stderr": stderr.decode("utf-8"),
+                "timed_out": timed_out }
+
+    if programs != cache:
+        try:
+            write_cache(cache_path, programs)
+        except (IOError, OSError):
+            pass  # Read-only programs directory
+
+    return dict((tuple(name.split("_", 1)), entry)
+            for name, entry in programs.iteritems()), len(tasks)
+
+def write_outputs(results, programs_dir=PROGRAMS_DIR, dry_run=False):
+    """Writes the stdout of programs that exited cleanly to their output
+    files (programs/output/<base>_<version>.py.txt) if it differs. Returns
+    the (base, version) of changed outputs."""
+    files = program_files(programs_dir)
+    changed = []
+    for key, entry in sorted(results.iteritems()):
+        if (entry["returncode"] != 0) or entry["timed_out"]:
+            continue
+
+        output_path = files[key][1]
+        output = entry["stdout"].encode("utf-8")
+        if read_text(output_path)[0] == output:
+            continue
+
+        changed.append(key)
+        if not dry_run:
+            if not os.path.exists(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+
+            with open(output_path, "wb") as output_file:
+                output_file.write(output)
+
+    return changed
+
+# }}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the stimulus programs in isolated subprocesses and updates their true outputs")
+    parser.add_argument("--programs", type=str, default=PROGRAMS_DIR,
+            help="Directory with program sources")
+    parser.add_argument("--python", type=str, default=sys.executable,
+            help="Interpreter for the programs (they are Python 2)")
+    parser.add_argument("-t", "--timeout", type=float, default=TIMEOUT,
+            help="Seconds before a program is killed")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of worker processes (default: number of cores)")
+    parser.add_argument("--refresh", action="store_true",
+            help="Run every program, even if its output is cached")
+    parser.add_argument("--check", action="store_true",
+            help="Only report outputs that differ from programs/output")
+    args = parser.parse_args()
+
+    results, run = run_programs(args.programs, args.python, args.timeout,
+            args.processes or multiprocessing.cpu_count(), args.refresh)
+
+    print "{0} programs ({1} run)".format(len(results), run)
+
+    failed = False
+    for (base, version), entry in sorted(results.iteritems()):
+        if entry["timed_out"]:
+            print "{0}_{1}: timed out".format(base, version)
+            failed = True
+        elif entry["returncode"] != 0:
+            print "{0}_{1}: exit code {2}".format(base, version, entry["returncode"])
+            if len(entry["stderr"].strip()) > 0:
+                print entry["stderr"].encode("utf-8").rstrip()
+            failed = True
+
+    changed = write_outputs(results, args.programs, args.check)
+    for base, version in changed:
+        print "{0}_{1}: output {2}".format(base, version,
+                "differs" if args.check else "updated")
+
+    if failed or (args.check and (len(changed) > 0)):
+        sys.exit(1)
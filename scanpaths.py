@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+import sys, argparse, numpy as np, pandas
+from scipy import sparse
+from aoi import Layout, DEFAULT_LAYOUT, ProgramAOIs
+from tobii_align import TIME_SCALE, trial_intervals, experiment_rows, assign_trials, \
+        session_exp_ids, warn_overlaps
+from gaze_heatmap import program_keys
+
+# Line AOIs {{{
+
+def fixation_lines(x, y, groups, keys, layout=DEFAULT_LAYOUT):
+    """Returns the line (0-based) under each fixation in its program, with
+    -1 for fixations off the code or without a program (group -1), and the
+    number of lines in each program"""
+    lines = np.full(len(x), -1, dtype=np.int64)
+    n_lines = np.zeros(len(keys), dtype=np.int64)
+
+    for g, (base, version) in enumerate(keys):
+        aois = ProgramAOIs.load(base, version, layout)
+        n_lines[g] = len(aois.lines)
+
+        in_group = groups == g
+        if in_group.any():
+            lines[in_group] = aois.assign(x[in_group], y[in_group])[0]
+
+    return lines, n_lines
+
+# }}}
+
+# Scanpaths and transitions {{{
+
+def run_lengths(trial_idx, lines, durations):
+    """Run-length encodes line sequences (sorted by trial, then time).
+    Returns the trial, line, fixation count and total duration of each run
+    of consecutive fixations on the same line."""
+    n = len(lines)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0)
+
+    changed = (trial_idx[1:] != trial_idx[:-1]) | (lines[1:] != lines[:-1])
+    starts = np.flatnonzero(np.r_[True, changed])
+    counts = np.diff(np.r_[starts, n])
+
+    return trial_idx[starts], lines[starts], counts, \
+            np.add.reduceat(np.asarray(durations, dtype="d"), starts)
+
+def transition_pairs(run_trials, run_lines):
+    """Returns the trial, from line and to line of each transition between
+    consecutive runs of the same trial"""
+    same = run_trials[1:] == run_trials[:-1]
+    return run_trials[:-1][same], run_lines[:-1][same], run_lines[1:][same]
+
+def trial_transitions(pair_trials, src, dst, n_max):
+    """Counts the distinct (trial, from, to) transitions. Returns sparse
+    (trial, from, to, count) arrays."""
+    codes = ((pair_trials * n_max) + src) * n_max + dst
+    codes, counts = np.unique(codes, return_counts=True)
+
+    return codes // (n_max * n_max), (codes // n_max) % n_max, codes % n_max, counts
+
+def program_transitions(pair_groups, src, dst, n_lines):
+    """Counts transitions per program with one bincount over the flattened
+    line x line matrices of every program. Returns a sparse (COO) matrix
+    for each program."""
+    sizes = n_lines * n_lines
+    offsets = np.r_[0, np.cumsum(sizes)]
+    counts = np.bincount(offsets[pair_groups] + (src * n_lines[pair_groups]) + dst,
+            minlength=offsets[-1])
+
+    return [sparse.coo_matrix(counts[offsets[g]:offsets[g + 1]].reshape(n, n))
+            for g, n in enumerate(n_lines)]
+
+def scanpaths(fixations, trials, starts, ends, layout=DEFAULT_LAYOUT):
+    """Builds line scanpaths and transition counts from fixations (with
+    start, duration, x and y columns) over the trials of trial_intervals.
+    Fixations with an exp_id column are only assigned to trials of that
+    experiment. Fixations off the code are dropped before run-length
+    encoding. Returns
+    a scanpath data frame (one row per run), a per-trial transition data
+    frame, the (base, version) program keys and a sparse transition matrix
+    for each program."""
+    keys, trial_groups = program_keys(trials)
+
+    timestamps = fixations["start"].values.astype(np.int64)
+    if "exp_id" in fixations.columns:
+        trial_idx = np.full(len(fixations), -1, dtype=np.int64)
+        for exp_id in np.unique(fixations["exp_id"].values):
+            in_exp = fixations["exp_id"].values == exp_id
+            trial_idx[in_exp] = assign_trials(timestamps[in_exp], starts, ends,
+                    experiment_rows(trials, exp_id))
+    else:
+        trial_idx = assign_trials(timestamps, starts, ends)
+
+    groups = np.where(trial_idx >= 0, trial_groups[np.maximum(trial_idx, 0)], -1)
+    lines, n_lines = fixation_lines(fixations["x"].values, fixations["y"].values,
+            groups, keys, layout)
+
+    # Sequences of on-code fixations, ordered by trial and time
+    on_code = np.flatnonzero(lines >= 0)
+    order = on_code[np.lexsort((fixations["start"].values[on_code], trial_idx[on_code]))]
+    run_trials, run_lines, run_counts, run_durations = run_lengths(trial_idx[order],
+            lines[order], fixations["duration"].values[order])
+
+    run_order = np.arange(len(run_trials)) - \
+            np.searchsorted(run_trials, run_trials, side="left")
+
+    trial_cols = ["exp_id", "id", "base", "version"]
+    paths = trials[trial_cols].iloc[run_trials].reset_index(drop=True)
+    paths["order"] = run_order
+    paths["line"] = run_lines + 1
+    paths["fixations"] = run_counts
+    paths["duration"] = run_durations
+
+    pair_trials, src, dst = transition_pairs(run_trials, run_lines)
+    # Programs without lines (or no programs at all) give empty matrices
+    t_trials, t_src, t_dst, t_counts = trial_transitions(pair_trials, src, dst,
+            max([1] + n_lines.tolist()))
+
+    transitions = trials[trial_cols].iloc[t_trials].reset_index(drop=True)
+    transitions["from_line"] = t_src + 1
+    transitions["to_line"] = t_dst + 1
+    transitions["count"] = t_counts
+
+    matrices = program_transitions(trial_groups[pair_trials], src, dst, n_lines)
+
+    return paths, transitions, keys, matrices
+
+def matrix_frame(keys, matrices):
+    """Returns program transition matrices as one long (COO) data frame
+    with 1-based line numbers"""
+    cols = ["base", "version", "from_line", "to_line", "count"]
+    frames = []
+    for (base, version), m in zip(keys, matrices):
+        frames.append(pandas.DataFrame({ "base": base, "version": version,
+            "from_line": m.row + 1, "to_line": m.col + 1, "count": m.data },
+            columns=cols))
+
+    if len(frames) == 0:
+        return pandas.DataFrame(columns=cols)
+
+    df = pandas.concat(frames, ignore_index=True)
+    return df.sort_values(["base", "version", "from_line", "to_line"]).reset_index(drop=True)
+
+# }}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Computes line scanpaths and line-to-line transition counts per trial and program")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("fixations", type=str, nargs="+",
+            help="Fixation csv files (see fixations.py)")
+    parser.add_argument("--time-scale", type=int, default=TIME_SCALE,
+            help="Fixation timestamp units per second")
+    parser.add_argument("--offset", type=int, default=0,
+            help="Fixation timestamp at 1970-01-01 00:00:00 in trial (local) time")
+    parser.add_argument("--left", type=float, default=DEFAULT_LAYOUT.left,
+            help="Screen x of the first character (pixels)")
+    parser.add_argument("--top", type=float, default=DEFAULT_LAYOUT.top,
+            help="Screen y of the first line (pixels)")
+    parser.add_argument("--char-width", type=float, default=DEFAULT_LAYOUT.char_width,
+            help="Width of a character (pixels)")
+    parser.add_argument("--line-height", type=float, default=DEFAULT_LAYOUT.line_height,
+            help="Height of a line (pixels)")
+    parser.add_argument("--scanpaths", type=str, default=None,
+            help="Write the line runs of each trial to a csv file")
+    parser.add_argument("--trial-transitions", type=str, default=None,
+            help="Write the transition counts of each trial to a csv file")
+    parser.add_argument("--exp-ids", type=int, nargs="+", default=None,
+            help="Experiment id of each fixation file, in order (fixations are only assigned to trials of that experiment)")
+    parser.add_argument("--no-cache", action="store_true",
+            help="Always re-parse the XML file (and its append log) instead of using the cached trial table")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write the per-program transition counts to a csv file instead of stdout")
+    args = parser.parse_args()
+    exp_ids = session_exp_ids(parser, args.fixations, args.exp_ids)
+
+    from trial_cache import load_trials
+    if args.no_cache:
+        trial_df = load_trials(args.xml_file, refresh=True, save=False)
+    else:
+        trial_df = load_trials(args.xml_file)
+
+    trials, starts, ends = trial_intervals(trial_df, args.time_scale, args.offset)
+    if args.exp_ids is None:
+        warn_overlaps(starts, ends)
+
+    frames = []
+    for path, exp_id in zip(args.fixations, exp_ids):
+        frames.append(pandas.read_csv(path))
+        if exp_id is not None:
+            frames[-1]["exp_id"] = exp_id
+
+    fixations = pandas.concat(frames, ignore_index=True)
+
+    layout = Layout(args.left, args.top, args.char_width, args.line_height)
+    paths, transitions, keys, matrices = scanpaths(fixations, trials, starts, ends, layout)
+
+    print >>sys.stderr, "{0:,} fixations in {1:,} line runs, {2:,} transitions in {3} trials".format(
+            len(fixations), len(paths), transitions["count"].sum(),
+            len(paths.drop_duplicates(["exp_id", "id"])))
+
+    if args.scanpaths is not None:
+        paths.to_csv(args.scanpaths, index=False)
+
+    if args.trial_transitions is not None:
+        transitions.to_csv(args.trial_transitions, index=False)
+
+    out_file = sys.stdout
+    if args.output is not None:
+        out_file = open(args.output, "wb")
+
+    matrix_frame(keys, matrices).to_csv(out_file, index=False)
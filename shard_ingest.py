@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+import os, re, io, argparse, multiprocessing, pandas
+from response_stats import parse_experiments, experiment_rows, frame_from_rows, read_dataframe
+from response_store import STORE_EXT
+
+# Start of an <experiment> element (but not the <experiments> root)
+EXPERIMENT_START = re.compile(br"<experiment[\s>]")
+
+# End of the root element
+EXPERIMENTS_END = b"</experiments>"
+
+# Block size used when scanning for shard boundaries
+SCAN_BLOCK_SIZE = 1 << 20
+
+def find_experiment(xml_file, offset):
+    """Returns the byte offset of the first <experiment> start tag at or
+    after offset, or None if there isn't one"""
+    overlap = len(b"<experiment ")
+    xml_file.seek(offset)
+    while True:
+        block = xml_file.read(SCAN_BLOCK_SIZE + overlap)
+        if len(block) == 0:
+            return None
+
+        match = EXPERIMENT_START.search(block)
+        if match is not None:
+            return offset + match.start()
+
+        if len(block) <= overlap:
+            return None
+
+        # Back up a little so tags straddling blocks aren't missed
+        offset += len(block) - overlap
+        xml_file.seek(offset)
+
+def experiment_ranges(xml_path, shards):
+    """Splits an uncompressed response data XML file into (at most)
+    shards byte ranges, each starting at an <experiment> start tag.
+    Returns a list of (start, end) offsets."""
+    size = os.path.getsize(xml_path)
+    with open(xml_path, "rb") as xml_file:
+        first = find_experiment(xml_file, 0)
+        if first is None:
+            return []
+
+        # End of the last experiment is the start of </experiments>
+        xml_file.seek(max(0, size - SCAN_BLOCK_SIZE))
+        tail = xml_file.read()
+        end = tail.rfind(EXPERIMENTS_END)
+        end = size if end < 0 else max(0, size - SCAN_BLOCK_SIZE) + end
+
+        starts = [first]
+        step = (end - first) // max(shards, 1)
+        for i in range(1, shards):
+            start = find_experiment(xml_file, first + (i * step))
+            if (start is not None) and (start < end) and (start > starts[-1]):
+                starts.append(start)
+
+    return zip(starts, starts[1:] + [end])
+
+def read_range(xml_path, start, end):
+    """Parses the experiments in a byte range of a response data XML file"""
+    with open(xml_path, "rb") as xml_file:
+        # The file's own prolog (XML declaration and root start tag) keeps
+        # its encoding, attributes and namespaces
+        prolog_end = find_experiment(xml_file, 0)
+        xml_file.seek(0)
+        prolog = xml_file.read(prolog_end)
+
+        xml_file.seek(start)
+        chunk = xml_file.read(end - start)
+
+    xml_data = io.BytesIO(prolog + chunk + EXPERIMENTS_END)
+    rows = []
+    for e in parse_experiments(xml_data):
+        rows.extend(experiment_rows(e))
+
+    return frame_from_rows(rows)
+
+def read_shard(shard):
+    """Parses a single shard, which is either (path,) or (path, start, end).
+    Errors are re-raised as a ValueError with the path, since some (like
+    lxml's) can't be sent back from a worker process."""
+    try:
+        if len(shard) == 1:
+            return read_dataframe(shard[0])
+
+        return read_range(*shard)
+    except Exception as err:
+        raise ValueError("{0}: {1}".format(shard[0], err))
+
+def make_shards(xml_paths, shards_per_file=1):
+    """Creates shards for a list of response data XML files. Uncompressed
+    files are split at <experiment> boundaries into shards_per_file byte
+    ranges; gzipped files and store files can't be split, so each is one
+    shard."""
+    shards = []
+    for path in xml_paths:
+        if (shards_per_file > 1) and (not path.endswith(".gz")) and \
+                (not path.endswith(STORE_EXT)):
+            shards.extend((path, start, end) for start, end
+                    in experiment_ranges(path, shards_per_file))
+        else:
+            shards.append((path,))
+
+    return shards
+
+def read_shards(xml_paths, processes=None, shards_per_file=None):
+    """Parses response data XML files in a process pool and returns a
+    single trial data frame, ordered by experiment and trial id.
+    By default, large uncompressed files are split into one shard per
+    process."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if shards_per_file is None:
+        shards_per_file = processes if len(xml_paths) < processes else 1
+
+    shards = make_shards(xml_paths, shards_per_file)
+    if (processes > 1) and (len(shards) > 1):
+        pool = multiprocessing.Pool(min(processes, len(shards)))
+        try:
+            frames = pool.map(read_shard, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        frames = [read_shard(s) for s in shards]
+
+    df = pandas.concat(frames, ignore_index=True)
+    df = df.sort_values(["exp_id", "id"], kind="mergesort")
+
+    return df.reset_index(drop=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parses many response data XML files (or shards of one large file) in parallel")
+    parser.add_argument("xml_files", type=str, nargs="+", help="Paths to response data xml files (.xml or .xml.gz) or store files ({0})".format(STORE_EXT))
+    parser.add_argument("-p", "--processes", type=int, default=None,
+            help="Number of worker processes (default: number of cores)")
+    parser.add_argument("-s", "--shards", type=int, default=None,
+            help="Number of byte-range shards per uncompressed file")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write the combined trial table to a feather file")
+    args = parser.parse_args()
+
+    trial_df = read_shards(args.xml_files, args.processes, args.shards)
+    print "{0} experiments".format(trial_df.exp_id.nunique())
+    print "{0} trials".format(len(trial_df))
+
+    if args.output is not None:
+        from trial_cache import typed_trials, write_trials
+        write_trials(typed_trials(trial_df), args.output)
@@ -0,0 +1,333 @@
+import io, os, csv, gzip, mmap, numpy as np, pandas
+from collections import defaultdict
+
+# Columns with the left/right eye validity codes (0 = best, 4 = missing)
+VALIDITY_COLUMNS = ("ValidityLeft", "ValidityRight")
+
+# Number of rows read at a time by the chunked readers
+CHUNK_SIZE = 1 << 18
+
+# Size of read/write buffers for data files
+BUFFER_SIZE = 1 << 20
+
+# Compression level for gzipped output (same as the gzip command)
+GZIP_LEVEL = 6
+
+def open_data(path, mode="rb", buffering=BUFFER_SIZE):
+    """Opens a Tobii data file, (de)compressing it if it ends in .gz"""
+    if path.endswith(".gz"):
+        if "r" in mode:
+            # GzipFile's own line reading is slow, so buffer in front of it
+            return io.BufferedReader(gzip.open(path, mode), buffering)
+
+        return gzip.open(path, mode, GZIP_LEVEL)
+
+    return open(path, mode, buffering)
+
+def read_header(path, tsv=False):
+    """Returns the column names of a Tobii csv/tsv file"""
+    dialect = "excel-tab" if tsv else "excel"
+    with open_data(path) as data_file:
+        return next(csv.reader(data_file, dialect=dialect), [])
+
+# Validity code text accepted by int() (like parse_codes, so "1.0" is not a code)
+INTEGER_TEXT = r"^\s*[-+]?\d+\s*$"
+
+# Validity columns are read as text so that only integer text counts
+VALIDITY_DTYPES = dict((c, str) for c in VALIDITY_COLUMNS)
+
+# Codes written as a single digit (nearly all of them) are looked up directly
+DIGIT_CODES = pandas.Series(np.arange(10, dtype=np.int64),
+        index=[str(d) for d in range(10)])
+
+def integer_codes(values):
+    """Converts a column of validity code text to integers, returning the
+    codes and a mask of the rows that hold integers"""
+    idx = DIGIT_CODES.index.get_indexer(values.values)
+    mask = idx >= 0
+    codes = np.where(mask, idx, 0).astype(np.int64)
+
+    # Anything else (except missing values) must match INTEGER_TEXT
+    rest = ~mask & values.notnull().values
+    if rest.any():
+        text = values[rest].astype(str)
+        is_int = text.str.match(INTEGER_TEXT).values
+        rest[rest] = is_int
+        codes[rest] = text[is_int].str.strip().astype(np.int64).values
+        mask |= rest
+
+    return codes, mask
+
+def read_validity_chunks(path, tsv=False, chunksize=CHUNK_SIZE):
+    """Yields (left, right) arrays of integer validity codes from a Tobii
+    csv/tsv file, reading only the validity columns in large chunks.
+    Rows without integer codes in both columns are skipped."""
+    header = read_header(path, tsv)
+    if not all(c in header for c in VALIDITY_COLUMNS):
+        return
+
+    reader = pandas.read_csv(path, sep="\t" if tsv else ",",
+            usecols=VALIDITY_COLUMNS, dtype=VALIDITY_DTYPES, chunksize=chunksize,
+            compression="infer", error_bad_lines=False, warn_bad_lines=False)
+
+    for chunk in reader:
+        left, left_ok = integer_codes(chunk[VALIDITY_COLUMNS[0]])
+        right, right_ok = integer_codes(chunk[VALIDITY_COLUMNS[1]])
+        ok = left_ok & right_ok
+        yield left[ok].astype(int), right[ok].astype(int)
+
+def add_codes(codes, left, right):
+    """Adds the (left, right) validity code pairs in two arrays to a
+    histogram dictionary"""
+    if len(left) == 0:
+        return
+
+    pairs = pandas.DataFrame({ "left": left, "right": right })
+    for (v_left, v_right), count in pairs.groupby(["left", "right"]).size().iteritems():
+        codes[(int(v_left), int(v_right))] += int(count)
+
+def count_codes(path, tsv=False, chunksize=CHUNK_SIZE):
+    """Counts the (left, right) validity code pairs in a Tobii csv/tsv file"""
+    codes = defaultdict(int)
+    for left, right in read_validity_chunks(path, tsv, chunksize):
+        add_codes(codes, left, right)
+
+    return codes
+
+def merge_codes(all_codes):
+    """Sums a list of validity code histograms"""
+    total = defaultdict(int)
+    for codes in all_codes:
+        for v_both, count in codes.iteritems():
+            total[v_both] += count
+
+    return total
+
+def print_summary(codes, validmax, out=None):
+    """Prints the number of valid/invalid samples in a validity code histogram"""
+    total = sum(codes.values())
+    print >>out, "{0:,} samples".format(total)
+
+    if total == 0:
+        return  # No samples!
+
+    valid = 0
+    invalid = 0
+
+    for (v_both, count) in codes.iteritems():
+        if sum(v_both) > validmax:
+            invalid += count
+        else:
+            valid += count
+
+    print >>out, "Valid: {0:,} ({1:.0f}%)".format(valid,
+        valid / float(total) * 100)
+
+    print >>out, "Invalid: {0:,} ({1:.0f}%)".format(invalid,
+        invalid / float(total) * 100)
+
+# Raw filtering {{{
+
+# Bytes of input processed at a time when filtering
+BLOCK_SIZE = 1 << 26
+
+NEWLINE = ord(b"\n")
+QUOTE = ord(b"\"")
+ZERO = ord(b"0")
+
+def parse_codes(fields, indexes):
+    """Parses the validity codes at indexes from a list of fields, returning
+    None if any of them isn't an integer"""
+    try:
+        return [int(fields[i]) for i in indexes]
+    except (ValueError, IndexError):
+        return None
+
+def field_bounds(delims, line_starts, line_ends, index):
+    """Returns the (start, end) offsets of field number index in each line,
+    with end = -1 for lines that have fewer fields"""
+    first = np.searchsorted(delims, line_starts)
+    padded = np.r_[delims, line_ends[-1] if len(line_ends) > 0 else 0]
+
+    if index == 0:
+        starts = line_starts
+    else:
+        before = np.minimum(first + index - 1, len(delims))
+        starts = padded[before] + 1
+
+    after = np.minimum(first + index, len(delims))
+    ends = np.minimum(padded[after], line_ends)
+
+    # Line is too short if the field's leading delimiter is past its end
+    if index > 0:
+        ends[(first + index - 1 >= len(delims)) | (starts > line_ends)] = -1
+
+    return starts, ends
+
+def block_codes(block, indexes, delim, dialect):
+    """Decodes the validity codes of each line in a block of complete lines
+    (a uint8 array). Returns the line start and end offsets, an array of
+    codes with a row per line and a column per index, and a mask of the
+    lines whose codes are all integers. Single-digit codes are decoded
+    directly from the bytes; other lines are parsed with split, or the csv
+    module if they contain quotes."""
+    newlines = np.flatnonzero(block == NEWLINE)
+    line_ends = newlines + 1
+    if (len(block) > 0) and (block[-1] != NEWLINE):
+        line_ends = np.r_[line_ends, len(block)]
+
+    line_starts = np.r_[0, line_ends[:-1]]
+
+    # Strip line terminators (\n or \r\n) from field ends
+    content_ends = line_ends.copy()
+    content_ends[block[line_ends - 1] == NEWLINE] -= 1
+    has_cr = (content_ends > line_starts) & (block[np.maximum(content_ends - 1, 0)] == ord(b"\r"))
+    content_ends[has_cr] -= 1
+
+    delims = np.flatnonzero(block == ord(delim))
+
+    # Fast path: unquoted lines with single digit codes
+    fast = np.ones(len(line_starts), dtype=bool)
+    quoted = np.zeros(len(line_starts), dtype=bool)
+    quotes = np.flatnonzero(block == QUOTE)
+    if len(quotes) > 0:
+        quoted[np.searchsorted(line_ends, quotes, side="right")] = True
+        fast &= ~quoted
+
+    codes = np.zeros((len(line_starts), len(indexes)), dtype=int)
+    for j, index in enumerate(indexes):
+        starts, ends = field_bounds(delims, line_starts, content_ends, index)
+        single = (ends - starts) == 1
+        digits = block[np.minimum(starts, len(block) - 1)].astype(int) - ZERO
+        single &= (digits >= 0) & (digits <= 9)
+        fast &= single
+        codes[:, j] = np.where(single, digits, 0)
+
+    ok = fast.copy()
+
+    # Slow path: everything else
+    for i in np.flatnonzero(~fast):
+        line = block[line_starts[i]:content_ends[i]].tostring()
+        if quoted[i]:
+            fields = next(csv.reader([line], dialect=dialect), [])
+        else:
+            fields = line.split(delim, max(indexes) + 1)
+
+        line_codes = parse_codes(fields, indexes)
+        if line_codes is not None:
+            codes[i] = line_codes
+            ok[i] = True
+
+    return line_starts, line_ends, codes, ok
+
+def line_runs(keep, line_starts, line_ends):
+    """Merges consecutive kept lines into (start, end) offset runs"""
+    edges = np.diff(np.r_[0, keep.astype(np.int8), 0])
+    run_starts = line_starts[np.flatnonzero(edges == 1)]
+    run_ends = line_ends[np.flatnonzero(edges == -1) - 1]
+
+    return zip(run_starts, run_ends)
+
+def filter_block(block, indexes, delim, validmax, dialect):
+    """Finds the valid lines in a block of complete lines (a uint8 array).
+    Returns a list of the (start, end) offsets of runs of valid lines."""
+    line_starts, line_ends, codes, ok = block_codes(block, indexes, delim, dialect)
+    keep = ok & (codes.sum(axis=1) <= validmax)
+
+    return line_runs(keep, line_starts, line_ends)
+
+def iter_blocks(data, block_size=BLOCK_SIZE):
+    """Yields blocks of complete lines from a uint8 array (e.g. a memory
+    mapped file) as array views"""
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + block_size, size)
+        if end < size:
+            newlines = np.flatnonzero(data[start:end] == NEWLINE)
+            if len(newlines) > 0:
+                end = start + newlines[-1] + 1
+            else:
+                # Line is longer than a block
+                newlines = np.flatnonzero(data[end:] == NEWLINE)
+                end = (end + newlines[0] + 1) if len(newlines) > 0 else size
+
+        yield data[start:end]
+        start = end
+
+def iter_file_blocks(in_file, block_size=BLOCK_SIZE):
+    """Yields blocks of complete lines read from a file as uint8 arrays"""
+    remainder = b""
+    while True:
+        chunk = in_file.read(block_size)
+        if len(chunk) == 0:
+            break
+
+        buf = remainder + chunk
+        cut = buf.rfind(b"\n") + 1
+        remainder = buf[cut:]
+        if cut > 0:
+            yield np.frombuffer(buf[:cut], dtype=np.uint8)
+
+    if len(remainder) > 0:
+        yield np.frombuffer(remainder, dtype=np.uint8)
+
+def data_blocks(path, block_size=BLOCK_SIZE):
+    """Yields blocks of complete lines from a Tobii data file. Uncompressed
+    files are memory-mapped; gzipped files are decompressed in blocks."""
+    if path.endswith(".gz"):
+        with open_data(path) as in_file:
+            for block in iter_file_blocks(in_file, block_size):
+                yield block
+
+        return
+
+    with open(path, "rb") as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return
+
+        mm = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for block in iter_blocks(np.frombuffer(mm, dtype=np.uint8), block_size):
+                yield block
+        finally:
+            mm.close()
+
+def split_header(block, dialect):
+    """Splits the header line off the first block of a Tobii data file.
+    Returns the header fields, the rest of the block and the indexes of
+    the validity columns (None if they are missing)."""
+    newlines = np.flatnonzero(block == NEWLINE)
+    header_end = (newlines[0] + 1) if len(newlines) > 0 else len(block)
+    header = next(csv.reader([block[:header_end].tostring()], dialect=dialect), [])
+
+    indexes = None
+    if all(c in header for c in VALIDITY_COLUMNS):
+        indexes = [header.index(c) for c in VALIDITY_COLUMNS]
+
+    return header, block[:header_end], block[header_end:], indexes
+
+def filter_blocks(blocks, out_file, validmax, tsv=False):
+    """Writes the header and valid samples from blocks of Tobii data (see
+    data_blocks) to out_file, copying the raw bytes of each kept line"""
+    dialect = "excel-tab" if tsv else "excel"
+    delim = b"\t" if tsv else b","
+    indexes = None
+
+    for i, block in enumerate(blocks):
+        if i == 0:
+            _, header_line, block, indexes = split_header(block, dialect)
+            out_file.write(header_line)
+
+        if (indexes is None) or (len(block) == 0):
+            continue  # No valid samples
+
+        for start, end in filter_block(block, indexes, delim, validmax, dialect):
+            out_file.write(block[start:end])
+
+def filter_valid(path, out_file, validmax, tsv=False, block_size=BLOCK_SIZE):
+    """Writes the valid samples of a Tobii csv/tsv file to out_file without
+    re-serializing them"""
+    filter_blocks(data_blocks(path, block_size), out_file, validmax, tsv)
+
+# }}}
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+import sys, argparse, numpy as np, pandas
+from tobii import CHUNK_SIZE, VALIDITY_COLUMNS, VALIDITY_DTYPES, read_header, \
+        integer_codes
+from tobii_store import STORE_EXT, TIME_COLUMN, MISSING_CODE, open_store, iter_chunks, \
+        index_trials
+
+# Sample timestamps per second (Tobii timestamps are in microseconds)
+TIME_SCALE = 1000000
+
+EPOCH = pandas.Timestamp("1970-01-01")
+
+def trial_intervals(trial_df, time_scale=TIME_SCALE, offset=0):
+    """Returns the trials sorted by start time with [start, end) intervals
+    in sample time units: seconds since the epoch times time_scale plus
+    offset. Trial times only have second resolution, so each trial
+    includes its whole last second, and ends are clipped to the start of
+    the next trial of the same experiment so that an experiment's
+    intervals never overlap. Experiments (participants) can overlap each
+    other; see experiment_rows."""
+    trials = trial_df[["exp_id", "id", "base", "version", "started", "ended"]]
+    trials = trials.sort_values(["started", "exp_id", "id"]).reset_index(drop=True)
+
+    starts = (((trials["started"] - EPOCH) // pandas.Timedelta(seconds=1)).values
+            .astype(np.int64) * time_scale) + offset
+
+    ends = ((((trials["ended"] - EPOCH) // pandas.Timedelta(seconds=1)).values
+            .astype(np.int64) + 1) * time_scale) + offset
+
+    # Each trial is followed by the next one of its experiment
+    by_exp = np.argsort(trials["exp_id"].values, kind="mergesort")
+    if len(by_exp) > 1:
+        exp_ids = trials["exp_id"].values[by_exp]
+        same = exp_ids[1:] == exp_ids[:-1]
+        current, following = by_exp[:-1][same], by_exp[1:][same]
+        ends[current] = np.minimum(ends[current], starts[following])
+
+    return trials, starts, np.maximum(ends, starts)
+
+def experiment_rows(trials, exp_id):
+    """Returns the rows of an experiment's trials in a trial_intervals table"""
+    return np.flatnonzero(trials["exp_id"].values == exp_id)
+
+def assign_trials(timestamps, starts, ends, rows=None):
+    """Returns the index of the interval [starts[i], ends[i]) containing
+    each timestamp, or -1 if there is none. Intervals must be sorted and
+    disjoint; timestamps can be in any order. If rows is given, only those
+    intervals are searched (e.g. one experiment's, see experiment_rows).
+    Without rows, overlapping experiments share one timeline and each
+    timestamp goes to the trial that started last."""
+    if rows is not None:
+        if len(rows) == 0:
+            return np.full(len(timestamps), -1, dtype=np.int64)
+
+        idx = assign_trials(timestamps, starts[rows], ends[rows])
+        return np.where(idx >= 0, rows[np.maximum(idx, 0)], -1)
+
+    idx = np.searchsorted(starts, timestamps, side="right") - 1
+    found = idx >= 0
+    found[found] = timestamps[found] < ends[idx[found]]
+
+    return np.where(found, idx, -1)
+
+def overlapping_intervals(starts, ends):
+    """Returns the number of trial intervals that overlap the next one
+    (which can only happen across experiments)"""
+    return np.count_nonzero(ends[:-1] > starts[1:])
+
+def warn_overlaps(starts, ends):
+    """Warns on stderr if trials of different experiments overlap, since
+    without --exp-ids their samples go to whichever trial started last"""
+    overlaps = overlapping_intervals(starts, ends)
+    if overlaps > 0:
+        print >>sys.stderr, "{0:,} trial intervals overlap trials of other experiments; samples in the overlaps go to the trial that started last (use --exp-ids)".format(
+                overlaps)
+
+def session_exp_ids(parser, paths, exp_ids):
+    """Checks the --exp-ids option of a script against its files. Returns
+    the experiment id of each file (None for all if no ids were given)."""
+    if exp_ids is None:
+        return [None] * len(paths)
+
+    if len(exp_ids) != len(paths):
+        parser.error("--exp-ids needs one experiment id per file")
+
+    return exp_ids
+
+def export_chunks(path, tsv=False, chunksize=CHUNK_SIZE, time_column=TIME_COLUMN):
+    """Yields (timestamps, left codes, right codes, ok) from a Tobii export,
+    where ok marks samples with a timestamp and integer validity codes"""
+    header = read_header(path, tsv)
+    missing = [c for c in (time_column,) + VALIDITY_COLUMNS if c not in header]
+    if len(missing) > 0:
+        raise ValueError("Missing columns in {0}: {1}".format(path, ", ".join(missing)))
+
+    reader = pandas.read_csv(path, sep="\t" if tsv else ",",
+            usecols=(time_column,) + VALIDITY_COLUMNS, dtype=VALIDITY_DTYPES,
+            chunksize=chunksize,
+            compression="infer", error_bad_lines=False, warn_bad_lines=False)
+
+    for chunk in reader:
+        timestamps = pandas.to_numeric(chunk[time_column], errors="coerce").values
+        left, left_ok = integer_codes(chunk[VALIDITY_COLUMNS[0]])
+        right, right_ok = integer_codes(chunk[VALIDITY_COLUMNS[1]])
+        ok = np.isfinite(timestamps) & left_ok & right_ok
+
+        yield (np.where(ok, timestamps, 0).astype(np.int64),
+                np.where(ok, left, 0).astype(int), np.where(ok, right, 0).astype(int), ok)
+
+def store_chunks(store_path, chunksize=CHUNK_SIZE):
+    """Yields (timestamps, left codes, right codes, ok) from a gaze store"""
+    samples, _ = open_store(store_path)
+    for chunk in iter_chunks(samples, chunksize):
+        left = chunk["validity_left"].astype(int)
+        right = chunk["validity_right"].astype(int)
+        yield chunk["timestamp"], left, right, (left != MISSING_CODE) & (right != MISSING_CODE)
+
+def align_chunks(chunks, starts, ends, validmax, rows=None):
+    """Counts the samples (with validity codes) and valid samples in each
+    trial interval (or only the intervals in rows) over a stream of sample
+    chunks. Returns arrays of sample and valid counts per trial, and the
+    number of samples outside every trial."""
+    samples = np.zeros(len(starts), dtype=np.int64)
+    valid = np.zeros(len(starts), dtype=np.int64)
+    unassigned = 0
+
+    for timestamps, left, right, ok in chunks:
+        idx = assign_trials(timestamps[ok], starts, ends, rows)
+        is_valid = (left[ok] + right[ok]) <= validmax
+        inside = idx >= 0
+
+        samples += np.bincount(idx[inside], minlength=len(starts))
+        valid += np.bincount(idx[inside & is_valid], minlength=len(starts))
+        unassigned += np.count_nonzero(~inside)
+
+    return samples, valid, unassigned
+
+def align_file(path, starts, ends, validmax, tsv=False, chunksize=CHUNK_SIZE,
+        rows=None):
+    """Counts the samples and valid samples in each trial interval (or only
+    the intervals in rows) for a Tobii export or gaze store (see
+    align_chunks)"""
+    if path.endswith(STORE_EXT):
+        chunks = store_chunks(path, chunksize)
+    else:
+        chunks = export_chunks(path, tsv, chunksize)
+
+    return align_chunks(chunks, starts, ends, validmax, rows)
+
+def trial_validity(trials, samples, valid):
+    """Builds the per-trial validity table"""
+    df = trials.copy()
+    df["samples"] = samples
+    df["valid"] = valid
+    df["invalid"] = samples - valid
+    df["valid_rate"] = np.where(samples > 0,
+            valid / np.maximum(samples, 1).astype(float), np.nan)
+
+    return df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assigns Tobii samples to trials and computes per-trial validity rates")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("csvfiles", type=str, nargs="+",
+            help="Tobii csv/tsv files or gaze stores ({0})".format(STORE_EXT))
+    parser.add_argument("--tsv", action="store_true")
+    parser.add_argument("-v", "--validmax", type=int, default=1,
+            help="Maximum valid code (Tobii recommends 1)")
+    parser.add_argument("--time-scale", type=int, default=TIME_SCALE,
+            help="Sample timestamp units per second")
+    parser.add_argument("--offset", type=int, default=0,
+            help="Sample timestamp at 1970-01-01 00:00:00 in trial (local) time")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE,
+            help="Number of samples to read at a time")
+    parser.add_argument("--exp-ids", type=int, nargs="+", default=None,
+            help="Experiment id of each file, in order (samples are only assigned to trials of that experiment)")
+    parser.add_argument("--all", action="store_true",
+            help="Include trials without any samples")
+    parser.add_argument("--index", action="store_true",
+            help="Store the sample range of each trial in gaze stores (see tobii_store.py)")
+    parser.add_argument("--no-cache", action="store_true",
+            help="Always re-parse the XML file (and its append log) instead of using the cached trial table")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write the per-trial table to a csv file instead of stdout")
+    args = parser.parse_args()
+    exp_ids = session_exp_ids(parser, args.csvfiles, args.exp_ids)
+
+    from trial_cache import load_trials
+    if args.no_cache:
+        trial_df = load_trials(args.xml_file, refresh=True, save=False)
+    else:
+        trial_df = load_trials(args.xml_file)
+
+    trials, starts, ends = trial_intervals(trial_df, args.time_scale, args.offset)
+    if args.exp_ids is None:
+        warn_overlaps(starts, ends)
+
+    samples = np.zeros(len(trials), dtype=np.int64)
+    valid = np.zeros(len(trials), dtype=np.int64)
+
+    for path, exp_id in zip(args.csvfiles, exp_ids):
+        rows = None if exp_id is None else experiment_rows(trials, exp_id)
+        if (rows is not None) and (len(rows) == 0):
+            print >>sys.stderr, "{0}: no trials for experiment {1}".format(path, exp_id)
+
+        f_samples, f_valid, unassigned = align_file(path, starts, ends,
+                args.validmax, args.tsv, args.chunksize, rows)
+
+        samples += f_samples
+        valid += f_valid
+        print >>sys.stderr, "{0}: {1:,} samples in {2} trials, {3:,} outside trials".format(
+                path, f_samples.sum(), np.count_nonzero(f_samples), unassigned)
+
+        if args.index and path.endswith(STORE_EXT):
+            has_samples = np.flatnonzero(f_samples > 0)
+            index_trials(path, [{ "exp_id": int(trials["exp_id"][i]),
+                "id": int(trials["id"][i]), "start": int(starts[i]),
+                "end": int(ends[i]) - 1 } for i in has_samples])
+
+    report = trial_validity(trials, samples, valid)
+    if not args.all:
+        report = report[report["samples"] > 0]
+
+    out_file = sys.stdout
+    if args.output is not None:
+        out_file = open(args.output, "wb")
+
+    report.to_csv(out_file, index=False)
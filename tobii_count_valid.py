@@ -1,54 +1,54 @@
-import csv, argparse, sys
-from collections import defaultdict
-
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Counts the number of valid/invalid samples in a Tobii data file")
-
-# The Tobii developer's guide suggests that samples
-# with a validity code of 2 or higher should be
-# considered "invalid"
-parser.add_argument("-v", "--validmax", type=int, default=1,
-        help="Maximum valid code (Tobii recommends 1)")
-
-parser.add_argument("--tsv", action="store_true")
-parser.add_argument("csvfile", type=str)
-args = parser.parse_args()
-
-# Count up left/right validity codes
-codes = defaultdict(int)
-with open(args.csvfile, "r") as csv_file:
-    dialect = "excel"
-    if args.tsv:
-        dialect = "excel-tab"
-
-    reader = csv.DictReader(csv_file, dialect=dialect)
-    for row in reader:
-        try:
-            v_left = int(row["ValidityLeft"])
-            v_right = int(row["ValidityRight"])
-            codes[(v_left, v_right)] += 1
-        except:
-            pass
-
-# Print results
-total = sum(codes.values())
-print("{0:,} samples".format(total))
-
-if total == 0:
-    sys.exit(0)  # No samples!
-
-valid = 0
-invalid = 0
-
-for (v_both, count) in codes.iteritems():
-    if sum(v_both) > args.validmax:
-        invalid += count
-    else:
-        valid += count
-
-print("Valid: {0:,} ({1:.0f}%)".format(valid,
-    valid / float(total) * 100))
-
-print("Invalid: {0:,} ({1:.0f}%)".format(invalid,
-    invalid / float(total) * 100))
-
+import sys, argparse
+from multiprocessing.pool import ThreadPool
+from tobii import CHUNK_SIZE, count_codes, merge_codes, print_summary
+from tobii_store import STORE_EXT, read_meta, store_codes
+
+if __name__ == "__main__":
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Counts the number of valid/invalid samples in Tobii data files")
+
+    # The Tobii developer's guide suggests that samples
+    # with a validity code of 2 or higher should be
+    # considered "invalid"
+    parser.add_argument("-v", "--validmax", type=int, default=1,
+            help="Maximum valid code (Tobii recommends 1)")
+
+    parser.add_argument("--tsv", action="store_true")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE,
+            help="Number of rows to read at a time")
+    parser.add_argument("-j", "--threads", type=int, default=4,
+            help="Number of files to count in parallel")
+    parser.add_argument("csvfiles", type=str, nargs="+",
+            help="Tobii csv/tsv files or gaze stores ({0})".format(STORE_EXT))
+    args = parser.parse_args()
+
+    def count_file(path):
+        if path.endswith(STORE_EXT):
+            # Stores don't keep samples without a timestamp
+            dropped = read_meta(path).get("dropped_codes", 0)
+            if dropped > 0:
+                print >>sys.stderr, "{0}: {1:,} samples without a timestamp were dropped at import".format(
+                        path, dropped)
+
+            return store_codes(path, args.chunksize)
+
+        return count_codes(path, args.tsv, args.chunksize)
+
+    # Count up left/right validity codes (one file per thread)
+    pool = ThreadPool(max(1, min(args.threads, len(args.csvfiles))))
+    try:
+        all_codes = pool.map(count_file, args.csvfiles)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Print results
+    if len(args.csvfiles) > 1:
+        for path, codes in zip(args.csvfiles, all_codes):
+            print(path)
+            print_summary(codes, args.validmax)
+            print("")
+
+        print("Total")
+
+    print_summary(merge_codes(all_codes), args.validmax)
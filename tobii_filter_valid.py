@@ -1,41 +1,38 @@
-import csv, argparse, sys
+import argparse, sys
+from tobii import filter_valid
+from tobii_store import STORE_EXT, filter_store
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Filters a Tobii data file so that only valid samples are written out")
-parser.add_argument("-v", "--validmax", type=int, default=1,
-        help="Maximum valid code (Tobii recommends 1)")
+if __name__ == "__main__":
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Filters a Tobii data file so that only valid samples are written out")
+    parser.add_argument("-v", "--validmax", type=int, default=1,
+            help="Maximum valid code (Tobii recommends 1)")
 
-parser.add_argument("--tsv", action="store_true",
-        help="Read and write tab-separated (tsv) instead of comma-separated (csv) data")
+    parser.add_argument("--tsv", action="store_true",
+            help="Read and write tab-separated (tsv) instead of comma-separated (csv) data")
 
-parser.add_argument("-o", "--output", type=str, default=None,
-        help="Output filtered data to file instead of stdout")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Output filtered data to file instead of stdout")
 
-parser.add_argument("csvfile", type=str)
-args = parser.parse_args()
+    parser.add_argument("csvfile", type=str,
+            help="Tobii csv/tsv file or gaze store ({0})".format(STORE_EXT))
+    args = parser.parse_args()
 
-dialect = "excel"
-if args.tsv:
-    dialect = "excel-tab"
+    # Stores are filtered into a new store
+    if args.csvfile.endswith(STORE_EXT):
+        if (args.output is None) or (not args.output.endswith(STORE_EXT)):
+            parser.error("Filtering a gaze store requires an --output ending in {0}".format(STORE_EXT))
 
-# Read and write data
-with open(args.csvfile, "r") as in_file:
-    out_file = sys.stdout
+        filter_store(args.csvfile, args.output, args.validmax)
+        sys.exit(0)
 
+    # Copy valid lines straight from the input to the output
+    out_file = sys.stdout
     if args.output:
-        out_file = open(args.output, "w")
-
-    reader = csv.DictReader(in_file, dialect=dialect)
-    writer = csv.DictWriter(out_file, reader.fieldnames, dialect=dialect)
-    writer.writeheader()
-
-    for row in reader:
-        try:
-            v_left = int(row["ValidityLeft"])
-            v_right = int(row["ValidityRight"])
-
-            # Filter by validity code sum
-            if (v_left + v_right) <= args.validmax:
-                writer.writerow(row)
-        except:
-            pass
+        out_file = open(args.output, "wb")
+
+    try:
+        filter_valid(args.csvfile, out_file, args.validmax, args.tsv)
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
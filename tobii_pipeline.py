@@ -0,0 +1,106 @@
+import csv, sys, argparse
+from cStringIO import StringIO
+from collections import defaultdict
+from tobii import BLOCK_SIZE, data_blocks, split_header, block_codes, \
+        line_runs, add_codes, print_summary, open_data
+from tsv2csv import padded_rows
+
+def run_pipeline(path, out_file, validmax, tsv=False, to_csv=False,
+        block_size=BLOCK_SIZE):
+    """Reads a Tobii data file once, writing its valid samples to out_file
+    (or nothing if out_file is None) and returning the histogram of
+    (left, right) validity codes for all samples. If to_csv is True, tab
+    separated input is converted to comma-separated output; otherwise
+    kept lines are copied unchanged."""
+    dialect = "excel-tab" if tsv else "excel"
+    delim = b"\t" if tsv else b","
+    convert = tsv and to_csv
+    codes = defaultdict(int)
+    indexes = None
+    width = 0
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    for i, block in enumerate(data_blocks(path, block_size)):
+        if i == 0:
+            header, header_line, block, indexes = split_header(block, dialect)
+            width = len(header)
+            if out_file is not None:
+                if convert:
+                    writer.writerow(header)
+                else:
+                    buf.write(header_line)
+
+        if (indexes is not None) and (len(block) > 0):
+            line_starts, line_ends, line_codes, ok = block_codes(block,
+                    indexes, delim, dialect)
+
+            # Count every sample with integer codes
+            add_codes(codes, line_codes[ok, 0], line_codes[ok, 1])
+
+            if out_file is not None:
+                keep = ok & (line_codes.sum(axis=1) <= validmax)
+                for start, end in line_runs(keep, line_starts, line_ends):
+                    if convert:
+                        lines = block[start:end].tostring().splitlines(True)
+                        reader = csv.reader(lines, dialect=dialect)
+                        writer.writerows(padded_rows(reader, width))
+                    else:
+                        buf.write(block[start:end])
+
+        if out_file is not None:
+            out_file.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+
+    return codes
+
+if __name__ == "__main__":
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Converts, filters and counts a Tobii data file in a single pass")
+
+    # The Tobii developer's guide suggests that samples
+    # with a validity code of 2 or higher should be
+    # considered "invalid"
+    parser.add_argument("-v", "--validmax", type=int, default=1,
+            help="Maximum valid code (Tobii recommends 1)")
+
+    parser.add_argument("--tsv", action="store_true",
+            help="Input is tab-separated (tsv) instead of comma-separated (csv) data")
+
+    parser.add_argument("--csv", action="store_true",
+            help="Convert tab-separated input to comma-separated output")
+
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Output filtered data to file (.gz to compress) instead of stdout")
+
+    parser.add_argument("--count-only", action="store_true",
+            help="Only count valid/invalid samples (no filtered output)")
+
+    parser.add_argument("-s", "--summary", type=str, default=None,
+            help="Write the valid/invalid summary to a file")
+
+    parser.add_argument("csvfile", type=str)
+    args = parser.parse_args()
+
+    out_file = None
+    if not args.count_only:
+        out_file = sys.stdout
+        if args.output:
+            out_file = open_data(args.output, "wb")
+
+    try:
+        codes = run_pipeline(args.csvfile, out_file, args.validmax,
+                args.tsv, args.csv)
+    finally:
+        if out_file not in (None, sys.stdout):
+            out_file.close()
+
+    # Keep the summary separate from filtered data on stdout
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            print_summary(codes, args.validmax, summary_file)
+    else:
+        print_summary(codes, args.validmax,
+                sys.stderr if out_file is sys.stdout else sys.stdout)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+import os, json, argparse, numpy as np, pandas
+from collections import defaultdict
+from tobii import CHUNK_SIZE, VALIDITY_COLUMNS, VALIDITY_DTYPES, read_header, \
+        integer_codes, add_codes
+
+# Extension of gaze sample stores (metadata is in <store>.json)
+STORE_EXT = ".gaze"
+
+# Bump when the layout of the store changes
+STORE_VERSION = 2
+
+# Fixed-width record for a single gaze sample. Missing gaze points are NaN
+# and missing validity codes are MISSING_CODE (exports may contain negative
+# codes, so -1 can't be used).
+SAMPLE_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("validity_left", "<i4"),
+    ("validity_right", "<i4")
+])
+
+MISSING_CODE = np.iinfo(np.int32).min
+
+# Default Tobii export columns for timestamp and gaze point
+TIME_COLUMN = "Timestamp"
+X_COLUMN = "GazePointX"
+Y_COLUMN = "GazePointY"
+
+def store_path_for(path):
+    """Returns the default store path for a Tobii export"""
+    root, ext = os.path.splitext(path)
+    if ext == ".gz":
+        root = os.path.splitext(root)[0]
+
+    return root + STORE_EXT
+
+def meta_path_for(store_path):
+    """Returns the path of a store's JSON metadata sidecar"""
+    return store_path + ".json"
+
+def read_meta(store_path):
+    """Reads the metadata (sample count, time range, trial index) of a store"""
+    with open(meta_path_for(store_path), "r") as meta_file:
+        meta = json.load(meta_file)
+
+    if meta.get("version") != STORE_VERSION:
+        raise ValueError("Unsupported gaze store version in {0}".format(store_path))
+
+    return meta
+
+def write_meta(store_path, meta):
+    """Writes the metadata sidecar of a store (with the store version)"""
+    meta["version"] = STORE_VERSION
+    with open(meta_path_for(store_path), "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+def open_store(store_path):
+    """Memory-maps the samples of a gaze store. Returns the samples (a
+    structured array with SAMPLE_DTYPE) and the store's metadata."""
+    meta = read_meta(store_path)
+    if meta["samples"] == 0:
+        return np.zeros(0, dtype=SAMPLE_DTYPE), meta
+
+    samples = np.memmap(store_path, dtype=SAMPLE_DTYPE, mode="r",
+            shape=(meta["samples"],))
+
+    return samples, meta
+
+def chunk_samples(chunk, time_column, x_column, y_column):
+    """Converts a chunk of a Tobii export to gaze sample records. Rows
+    without a numeric timestamp can't be placed in time, so they are
+    dropped. Returns the samples, the number of dropped rows and how many
+    of those had integer validity codes (and would be counted by
+    tobii.count_codes)."""
+    timestamps = pandas.to_numeric(chunk[time_column], errors="coerce").values
+    has_time = np.isfinite(timestamps)
+    has_codes = np.ones(len(chunk), dtype=bool)
+
+    samples = np.zeros(np.count_nonzero(has_time), dtype=SAMPLE_DTYPE)
+    samples["timestamp"] = timestamps[has_time]
+
+    for field, column in (("x", x_column), ("y", y_column)):
+        if column is not None:
+            values = pandas.to_numeric(chunk[column], errors="coerce").values
+            samples[field] = values[has_time]
+        else:
+            samples[field] = np.nan
+
+    for field, column in zip(("validity_left", "validity_right"), VALIDITY_COLUMNS):
+        codes, ok = integer_codes(chunk[column])
+        ok &= (codes > MISSING_CODE) & (codes <= np.iinfo(np.int32).max)
+        samples[field] = np.where(ok, codes, MISSING_CODE)[has_time]
+        has_codes &= ok
+
+    dropped = ~has_time
+    return samples, np.count_nonzero(dropped), np.count_nonzero(dropped & has_codes)
+
+def write_samples(store_path, chunks, meta):
+    """Writes chunks of gaze samples to a store file and updates the
+    sample count, time range and sortedness in meta"""
+    last = None
+    with open(store_path, "wb") as store_file:
+        for samples in chunks:
+            if len(samples) == 0:
+                continue
+
+            samples.tofile(store_file)
+            meta["samples"] += len(samples)
+
+            timestamps = samples["timestamp"]
+            start, end = int(timestamps.min()), int(timestamps.max())
+            if meta["time_range"] is not None:
+                start = min(start, meta["time_range"][0])
+                end = max(end, meta["time_range"][1])
+
+            meta["time_range"] = [start, end]
+
+            if ((last is not None) and (timestamps[0] < last)) or \
+                    (np.diff(timestamps) < 0).any():
+                meta["sorted"] = False
+
+            last = timestamps[-1]
+
+def import_export(path, store_path=None, tsv=False, chunksize=CHUNK_SIZE,
+        time_column=TIME_COLUMN, x_column=X_COLUMN, y_column=Y_COLUMN):
+    """Converts a Tobii csv/tsv export into a gaze sample store. Rows
+    without a numeric timestamp are dropped; their number (and how many
+    had validity codes) is recorded as "dropped" and "dropped_codes" in
+    the metadata. Returns the path of the store."""
+    if store_path is None:
+        store_path = store_path_for(path)
+
+    header = read_header(path, tsv)
+    missing = [c for c in (time_column,) + VALIDITY_COLUMNS if c not in header]
+    if len(missing) > 0:
+        raise ValueError("Missing columns in {0}: {1}".format(path, ", ".join(missing)))
+
+    # Gaze columns are optional
+    x_column = x_column if x_column in header else None
+    y_column = y_column if y_column in header else None
+    columns = [c for c in (time_column, x_column, y_column) + VALIDITY_COLUMNS
+            if c is not None]
+
+    reader = pandas.read_csv(path, sep="\t" if tsv else ",", usecols=columns,
+            dtype=VALIDITY_DTYPES, chunksize=chunksize, compression="infer", error_bad_lines=False,
+            warn_bad_lines=False)
+
+    meta = {
+        "source": os.path.abspath(path),
+        "columns": { "timestamp": time_column, "x": x_column, "y": y_column },
+        "samples": 0,
+        "time_range": None,
+        "sorted": True,
+        "dropped": 0,
+        "dropped_codes": 0,
+        "trials": []
+    }
+
+    def chunks():
+        for chunk in reader:
+            samples, dropped, dropped_codes = chunk_samples(chunk, time_column,
+                    x_column, y_column)
+
+            meta["dropped"] += dropped
+            meta["dropped_codes"] += dropped_codes
+            yield samples
+
+    write_samples(store_path, chunks(), meta)
+    write_meta(store_path, meta)
+
+    return store_path
+
+def iter_chunks(samples, chunksize=CHUNK_SIZE):
+    """Yields consecutive slices of a (memory-mapped) sample array"""
+    for start in xrange(0, len(samples), chunksize):
+        yield samples[start:start + chunksize]
+
+def store_codes(store_path, chunksize=CHUNK_SIZE):
+    """Counts the (left, right) validity code pairs in a gaze store"""
+    samples, _ = open_store(store_path)
+    codes = defaultdict(int)
+    for chunk in iter_chunks(samples, chunksize):
+        left, right = chunk["validity_left"], chunk["validity_right"]
+        ok = (left != MISSING_CODE) & (right != MISSING_CODE)
+        add_codes(codes, left[ok], right[ok])
+
+    return codes
+
+def valid_mask(samples, validmax):
+    """Returns a mask of the samples whose validity code sum is within validmax"""
+    left = samples["validity_left"].astype(int)
+    right = samples["validity_right"].astype(int)
+    return (left != MISSING_CODE) & (right != MISSING_CODE) & ((left + right) <= validmax)
+
+def filter_store(store_path, out_path, validmax, chunksize=CHUNK_SIZE):
+    """Writes the valid samples of a gaze store to a new store"""
+    samples, meta = open_store(store_path)
+    out_meta = dict(meta, samples=0, time_range=None, sorted=True,
+            trials=[], filtered={ "store": os.path.abspath(store_path), "validmax": validmax })
+
+    chunks = (c[valid_mask(c, validmax)] for c in iter_chunks(samples, chunksize))
+    write_samples(out_path, chunks, out_meta)
+    write_meta(out_path, out_meta)
+
+def time_slice(samples, start, end):
+    """Returns the (first, last + 1) sample indexes with start <= timestamp
+    <= end in a time-sorted sample array"""
+    timestamps = samples["timestamp"]
+    return (int(np.searchsorted(timestamps, start, side="left")),
+            int(np.searchsorted(timestamps, end, side="right")))
+
+def index_trials(store_path, trials):
+    """Stores the sample ranges of trials in a gaze store's index. trials is
+    a list of dictionaries with (at least) start and end timestamps in the
+    store's time units; first and last + 1 sample indexes are added."""
+    samples, meta = open_store(store_path)
+    if not meta["sorted"]:
+        raise ValueError("Samples in {0} are not sorted by time".format(store_path))
+
+    index = []
+    for trial in trials:
+        first, last = time_slice(samples, trial["start"], trial["end"])
+        index.append(dict(trial, first=first, last=last))
+
+    meta["trials"] = index
+    write_meta(store_path, meta)
+
+    return index
+
+def trial_samples(samples, meta, **keys):
+    """Returns the samples of the first indexed trial whose fields match
+    keys (e.g. exp_id=0, id=3), or None if there is no such trial"""
+    for trial in meta["trials"]:
+        if all(trial.get(k) == v for k, v in keys.iteritems()):
+            return samples[trial["first"]:trial["last"]]
+
+    return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports Tobii exports into compact, memory-mappable gaze sample stores")
+    parser.add_argument("csvfiles", type=str, nargs="+")
+    parser.add_argument("--tsv", action="store_true")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Path of the store (single file only, default: <export>{0})".format(STORE_EXT))
+    parser.add_argument("--time-column", type=str, default=TIME_COLUMN)
+    parser.add_argument("--x-column", type=str, default=X_COLUMN)
+    parser.add_argument("--y-column", type=str, default=Y_COLUMN)
+    args = parser.parse_args()
+
+    if (args.output is not None) and (len(args.csvfiles) > 1):
+        parser.error("--output can only be used with a single file")
+
+    for path in args.csvfiles:
+        store_path = import_export(path, args.output, args.tsv,
+                time_column=args.time_column, x_column=args.x_column,
+                y_column=args.y_column)
+
+        meta = read_meta(store_path)
+        print "{0}: {1:,} samples".format(store_path, meta["samples"])
+        if meta["dropped"] > 0:
+            print "  {0:,} rows without a timestamp were dropped ({1:,} with validity codes)".format(
+                    meta["dropped"], meta["dropped_codes"])
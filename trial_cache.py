@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+import os, sys, json, hashlib, argparse, pandas
+from response_stats import read_dataframe
+from program_metrics import metrics_sha1
+
+# Bump when the layout of the cached data frame changes
+CACHE_VERSION = 3
+
+# Columns stored as categoricals in the cache
+CATEGORY_COLUMNS = ("base", "version", "grade_category")
+
+def cache_paths(xml_path):
+    """Returns the paths of the columnar cache and its metadata for a
+    response data XML file"""
+    return ("{0}.trials.feather".format(xml_path),
+            "{0}.trials.json".format(xml_path))
+
+def append_log_path(xml_path):
+    """Returns the path of the log of experiments appended to a response
+    data XML file (see append_experiments.py). The log is a response data
+    file itself, and it is replayed whenever the cache is rebuilt."""
+    return "{0}.appended.xml".format(xml_path)
+
+def file_sha1(path, block_size=(1 << 20)):
+    """Computes the SHA-1 hex digest of a file's contents"""
+    sha = hashlib.sha1()
+    with open(path, "rb") as in_file:
+        for block in iter(lambda: in_file.read(block_size), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+def source_stamp(path, sha1=None):
+    """Describes a source file by size, modification time and content hash"""
+    st = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "sha1": sha1 if sha1 is not None else file_sha1(path)
+    }
+
+def check_source(stamp):
+    """Returns True if the source file described by stamp is unchanged.
+    The (cheap) size and mtime are checked first; the content hash is
+    only computed when the mtime differs (e.g. after a touch or copy),
+    in which case the stamp's mtime is refreshed in place."""
+    path = stamp["path"]
+    if not os.path.exists(path):
+        return False
+
+    st = os.stat(path)
+    if st.st_size != stamp["size"]:
+        return False
+
+    if st.st_mtime == stamp["mtime"]:
+        return True
+
+    if file_sha1(path) != stamp["sha1"]:
+        return False
+
+    stamp["mtime"] = st.st_mtime
+    return True
+
+def read_meta(meta_path):
+    """Reads cache metadata, or returns None if it is missing or stale"""
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, "r") as meta_file:
+        try:
+            meta = json.load(meta_file)
+        except ValueError:
+            return None
+
+    if meta.get("version") != CACHE_VERSION:
+        return None
+
+    # Program metrics (e.g. code_lines) are joined from programs/
+    if meta.get("metrics") != metrics_sha1():
+        return None
+
+    return meta
+
+def write_meta(meta_path, sources, trials):
+    """Writes cache metadata for the given source stamps, number of trials
+    and the current program metrics"""
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w") as meta_file:
+        json.dump({ "version": CACHE_VERSION, "sources": sources,
+            "trials": trials, "metrics": metrics_sha1() }, meta_file, indent=2)
+
+    os.rename(tmp_path, meta_path)
+
+def typed_trials(df):
+    """Converts the trial data frame to the column types used in the cache"""
+    df = df.reset_index(drop=True)
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+
+    return df
+
+def append_trials(df, new_df):
+    """Appends new trial rows to a (cached) trial data frame"""
+    df = df.astype(dict((c, object) for c in CATEGORY_COLUMNS))
+    return typed_trials(pandas.concat([df, new_df], ignore_index=True))
+
+def write_trials(df, cache_path):
+    """Writes the trial data frame to a columnar (feather) file"""
+    tmp_path = cache_path + ".tmp"
+    df.to_feather(tmp_path)
+    os.rename(tmp_path, cache_path)
+
+def save_trials(df, xml_path, sources):
+    """Stores a trial data frame in the cache next to xml_path. Returns
+    False if the columnar backend (pyarrow) is not installed."""
+    cache_path, meta_path = cache_paths(xml_path)
+    try:
+        write_trials(df, cache_path)
+    except ImportError:
+        return False
+
+    write_meta(meta_path, sources, len(df))
+    return True
+
+def cached_trials(xml_path):
+    """Returns the cached trial data frame for xml_path and its source
+    stamps, or (None, None) if there is no valid cache"""
+    cache_path, meta_path = cache_paths(xml_path)
+    meta = read_meta(meta_path)
+    if (meta is None) or (not os.path.exists(cache_path)):
+        return None, None
+
+    sources = meta["sources"]
+    mtimes = [s["mtime"] for s in sources]
+    if not all(check_source(s) for s in sources):
+        return None, None
+
+    # An append log that appeared since the cache was built
+    log_path = os.path.abspath(append_log_path(xml_path))
+    if os.path.exists(log_path) and (log_path not in [s["path"] for s in sources]):
+        return None, None
+
+    try:
+        df = pandas.read_feather(cache_path)
+    except ImportError:
+        return None, None
+
+    # Persist any refreshed mtimes so the hash isn't recomputed next time
+    if mtimes != [s["mtime"] for s in sources]:
+        write_meta(meta_path, sources, len(df))
+
+    return df, sources
+
+def cached_count(xml_path):
+    """Returns the number of trials in the existing cache of xml_path (even
+    a stale one), or None if there is none"""
+    cache_path, meta_path = cache_paths(xml_path)
+    try:
+        with open(meta_path, "r") as meta_file:
+            trials = json.load(meta_file).get("trials")
+    except (IOError, ValueError):
+        return None
+
+    # Caches before CACHE_VERSION 3 don't record their size
+    if trials is None:
+        try:
+            trials = len(pandas.read_feather(cache_path))
+        except (ImportError, IOError, ValueError):
+            return None
+
+    return trials
+
+def replay_appended(df, log_path):
+    """Adds the experiments in an append log to a trial data frame,
+    skipping (with a warning) experiments that are already in it"""
+    log_df = read_dataframe(log_path)
+    known = log_df["exp_id"].isin(df["exp_id"])
+    if known.any():
+        print >>sys.stderr, "{0}: skipping {1} experiment(s) already in the XML file".format(
+                log_path, log_df.loc[known, "exp_id"].nunique())
+
+    if known.all():
+        return df
+
+    return pandas.concat([df, log_df[~known]], ignore_index=True)
+
+def load_trials(xml_path, refresh=False, save=True):
+    """Loads the trial data frame for a response data XML file (and its
+    append log), using the columnar cache next to the file when it is
+    still valid. The cache is rebuilt automatically when the XML file, the
+    append log or the program metrics change. With refresh=True and
+    save=False, the files are parsed without touching the cache."""
+    if not refresh:
+        df, _ = cached_trials(xml_path)
+        if df is not None:
+            return df
+
+    # Hash before parsing so a file modified mid-parse is caught next time
+    log_path = append_log_path(xml_path)
+    sources = [source_stamp(xml_path)]
+    if os.path.exists(log_path):
+        sources.append(source_stamp(log_path))
+
+    df = read_dataframe(xml_path)
+    if len(sources) > 1:
+        df = replay_appended(df, log_path)
+
+    df = typed_trials(df)
+    if not save:
+        return df
+
+    old_trials = cached_count(xml_path)
+    if (old_trials is not None) and (len(df) < old_trials):
+        print >>sys.stderr, "Rebuilt trial table for {0} has {1} trials, but the old cache had {2}; the missing trials were dropped".format(
+                xml_path, len(df), old_trials)
+
+    save_trials(df, xml_path, sources)
+
+    return df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds or refreshes the cached trial table for a response data XML file")
+    parser.add_argument("xml_file", type=str, help="Path to reponse data xml file")
+    parser.add_argument("--refresh", action="store_true", help="Re-parse the XML file even if the cache is valid")
+    args = parser.parse_args()
+
+    trial_df = load_trials(args.xml_file, refresh=args.refresh)
+    print "{0} trials cached in {1}".format(len(trial_df),
+            cache_paths(args.xml_file)[0])
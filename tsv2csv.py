@@ -1,23 +1,89 @@
-import csv, os, argparse
+import csv, os, argparse, multiprocessing
+from itertools import islice
+from cStringIO import StringIO
+from tobii import open_data
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Converts a tab-separated (tsv) file to a comma-separated (csv) file")
-parser.add_argument("tsvfile", type=str)
-parser.add_argument("-o", "--output", type=str, default=None,
-        help="Write csv file to the given path instead of just changing the input path's extension")
-args = parser.parse_args()
+# Number of rows serialized before each write
+BATCH_SIZE = 10000
 
-tsv_path = args.tsvfile
-csv_path = args.output
+def csv_path_for(tsv_path):
+    """Returns the default csv path for a tsv path (keeping any .gz)"""
+    root, ext = os.path.splitext(tsv_path)
+    if ext == ".gz":
+        return "{0}.gz".format(csv_path_for(root))
 
-if csv_path is None:
-    csv_path = "{0}.csv".format(os.path.splitext(tsv_path)[0])
+    return "{0}.csv".format(root)
 
-with open(tsv_path, "r") as tsv_file:
-    with open(csv_path, "w") as csv_file:
-        reader = csv.DictReader(tsv_file, dialect="excel-tab")
-        writer = csv.DictWriter(csv_file, reader.fieldnames)
-        writer.writeheader()
+def padded_rows(reader, width):
+    """Skips blank rows and pads short rows with empty fields"""
+    for row in reader:
+        if len(row) < width:
+            if len(row) == 0:
+                continue
 
-        for row in reader:
-            writer.writerow(row)
+            row += [""] * (width - len(row))
+
+        yield row
+
+def convert(tsv_path, csv_path=None, batch_size=BATCH_SIZE):
+    """Converts a tab-separated file to a comma-separated file. Either file
+    may be gzipped (.gz). Returns the path of the csv file."""
+    if csv_path is None:
+        csv_path = csv_path_for(tsv_path)
+
+    with open_data(tsv_path, "rb") as tsv_file:
+        with open_data(csv_path, "wb") as csv_file:
+            reader = csv.reader(tsv_file, dialect="excel-tab")
+            header = next(reader, None)
+            if header is None:
+                return csv_path
+
+            # Serialize rows in batches so the output sees large writes
+            buf = StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(header)
+
+            rows = padded_rows(reader, len(header))
+            while True:
+                batch = list(islice(rows, batch_size))
+                writer.writerows(batch)
+                csv_file.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+
+                if len(batch) < batch_size:
+                    break
+
+    return csv_path
+
+def convert_pair(paths):
+    """Converts a (tsv path, csv path) pair (for Pool.map)"""
+    return convert(*paths)
+
+if __name__ == "__main__":
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Converts tab-separated (tsv) files to comma-separated (csv) files")
+    parser.add_argument("tsvfiles", type=str, nargs="+",
+            help="Paths to tsv files (.gz files are decompressed/compressed transparently)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Write csv file to the given path instead of just changing the input path's extension (single file only)")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+            help="Number of files to convert in parallel (default: number of cores)")
+    args = parser.parse_args()
+
+    if (args.output is not None) and (len(args.tsvfiles) > 1):
+        parser.error("--output can only be used with a single tsv file")
+
+    pairs = [(path, args.output) for path in args.tsvfiles]
+    processes = args.processes or multiprocessing.cpu_count()
+
+    if (processes > 1) and (len(pairs) > 1):
+        pool = multiprocessing.Pool(min(processes, len(pairs)))
+        try:
+            pool.map(convert_pair, pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for pair in pairs:
+            convert_pair(pair)